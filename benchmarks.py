@@ -0,0 +1,549 @@
+# Author: Joel Stansbury
+# Email: stansbury.joel@gmail.com
+"""
+Timings for the hot paths of better_tree.
+
+    python benchmarks.py                       # quick report
+    python benchmarks.py suite -o run.json     # every operation, as JSON
+    python benchmarks.py compare old.json run.json
+"""
+
+import argparse
+from contextlib import contextmanager
+import copy
+import json
+import os
+from pathlib import Path
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import comm
+from comm.base_comm import BaseComm
+from better_tree import Tree, TreeWidget
+
+
+def balanced_tree(n, fanout=10):
+    """A tree with roughly `n` nodes, `fanout` children per folder"""
+    tree = Tree()
+    frontier = ["root"]
+    count = 0
+    while count < n:
+        next_frontier = []
+        for parent_id in frontier:
+            for _ in range(fanout):
+                if count >= n:
+                    break
+                node_id = str(count)
+                node = {"id": node_id, "label": node_id, "type": "folder"}
+                tree._insert_nested_dict(node, parent_id=parent_id)
+                next_frontier.append(node_id)
+                count += 1
+        frontier = next_frontier
+    tree._housekeeping()
+    return tree
+
+
+def timeit(function, repeat=50):
+    """Mean seconds per call"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_move(n):
+    """
+    Per-mutation cost of `Tree.move` with a widget attached, versus the
+    full recompute that every mutation used to trigger.
+    """
+    tree = balanced_tree(n)
+    widget = TreeWidget(tree)
+    for node_id in tree.root.data["children"]:
+        widget._open_callback(node_id, True)
+    first, last = tree.root.data["children"][0], tree.root.data["children"][-1]
+    leaf = tree.registry[first].data["children"][0]
+
+    def move():
+        parent = last if tree.registry[leaf].parent == first else first
+        tree.move(leaf, parent, 0)
+
+    return {
+        "nodes": len(tree.registry),
+        "move": timeit(move),
+        "full_recompute": timeit(tree._housekeeping, repeat=5),
+    }
+
+
+def bench_import(n, fanout=1000):
+    """
+    `Tree(nodes=...)` from a flat `Tree.to_list()` export and a full `bfs`.
+    Both should scale linearly with the number of nodes.
+    """
+    exported = balanced_tree(n, fanout).to_list()
+    start = time.perf_counter()
+    tree = Tree(nodes=exported)
+    add_multiple = time.perf_counter() - start
+    bfs = timeit(lambda: sum(1 for _ in tree.bfs()), repeat=1)
+    return {"nodes": len(tree.registry), "add_multiple": add_multiple, "bfs": bfs}
+
+
+def bench_visible(n):
+    """
+    Opening a folder of `n` children, then `goto_node` and scrolling to
+    the bottom of it.
+    """
+    tree = Tree()
+    tree.insert_nested_dicts(
+        [{"id": "folder", "label": "folder", "type": "folder", "children": [
+            {"id": str(i), "label": str(i)} for i in range(n)
+        ]}]
+    )
+    widget = TreeWidget(tree)
+    start = time.perf_counter()
+    widget._open_callback("folder", True)
+    open_folder = time.perf_counter() - start
+    last = str(n - 1)
+    return {
+        "nodes": len(tree.registry),
+        "open": open_folder,
+        "goto_node": timeit(lambda: widget.goto_node(last)),
+        "scroll": timeit(lambda: widget.goto_index(len(widget.viewable_nodes) - 1)),
+    }
+
+
+def make_file_tree(root, n_files, per_directory=100):
+    """Create `n_files` empty files under `root`, `per_directory` per folder"""
+    for i in range(n_files):
+        directory = os.path.join(
+            root, f"d{i // per_directory ** 2}", f"d{i // per_directory}"
+        )
+        if i % per_directory == 0:
+            os.makedirs(directory, exist_ok=True)
+        open(os.path.join(directory, f"f{i}.txt"), "w").close()
+
+
+def legacy_rglob(tree, root, pattern):
+    """`Tree.rglob` as it was before the path index and scandir walker"""
+    root = Path(root)
+    skip = len(root.parts)
+    nodes = {"children": []}
+    for p in list(root.rglob(pattern)):
+        cursor = nodes
+        _id = root
+        for part in p.parts[skip:]:
+            _id = _id / part
+            if not part in [x["label"] for x in cursor["children"]]:
+                cursor["children"].append(
+                    {"id": str(_id), "label": part, "children": [], "type": "folder"}
+                )
+            cursor = [x for x in cursor["children"] if x["label"] == part][0]
+    tree.insert_nested_dicts(nodes["children"])
+
+
+def bench_rglob(n_files=500_000, workers=8):
+    with tempfile.TemporaryDirectory() as root:
+        make_file_tree(root, n_files)
+        result = {"files": n_files}
+        for name, build in [
+            ("legacy", lambda: legacy_rglob(Tree(), root, "*.txt")),
+            ("scandir", lambda: Tree().rglob(root, "*.txt")),
+            ("threaded", lambda: Tree().rglob(root, "*.txt", workers=workers)),
+        ]:
+            start = time.perf_counter()
+            build()
+            result[name] = time.perf_counter() - start
+        return result
+
+
+def bench_memory(n):
+    """Bytes allocated per node by `Tree.bulk_insert` of `n` small dicts"""
+    node_data = [{"label": f"file{i}.pdf", "type": "pdf"} for i in range(n)]
+    tracemalloc.start()
+    tree = Tree()
+    tree.bulk_insert(node_data)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"nodes": n, "bytes_per_node": current / n, "peak_per_node": peak / n}
+
+
+def bench_expand(n):
+    """`expand_subtree`, `collapse_subtree` and `expand_to_level(3)` on the root"""
+    tree = balanced_tree(n)
+    widget = TreeWidget(tree)
+    result = {"nodes": len(tree.registry)}
+    for name, function in [
+        ("expand", lambda: widget.expand_subtree("root")),
+        ("collapse", lambda: widget.collapse_subtree("root")),
+        ("expand_to_level", lambda: widget.expand_to_level(3)),
+    ]:
+        result[name] = timeit(function, repeat=1)
+    return result
+
+
+def bench_save(n):
+    """
+    `Tree.save`/`Tree.load` versus a JSON round trip of `Tree.to_list()`,
+    in seconds and peak bytes allocated per node.
+    """
+    tree = balanced_tree(n)
+    result = {"nodes": len(tree.registry)}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "tree.bin")
+        json_path = os.path.join(directory, "tree.json")
+
+        def save_load():
+            tree.save(path)
+            Tree.load(path)
+
+        def json_round_trip():
+            with open(json_path, "w") as f:
+                json.dump(tree.to_list(), f)
+            with open(json_path) as f:
+                Tree(nodes=json.load(f))
+
+        for name, function in [("save_load", save_load), ("json", json_round_trip)]:
+            tracemalloc.start()
+            start = time.perf_counter()
+            function()
+            result[name] = time.perf_counter() - start
+            result[name + "_peak"] = tracemalloc.get_traced_memory()[1] / n
+            tracemalloc.stop()
+        start = time.perf_counter()
+        Tree.load(path, lazy=True)
+        result["lazy_load"] = time.perf_counter() - start
+    return result
+
+
+def bench_search(n, query="final_99"):
+    """Building the search index over `n` labels, a query and a filter"""
+    words = ["alpha", "beta", "draft", "final", "image", "report", "table"]
+    tree = Tree()
+    tree.bulk_insert(
+        [{"label": f"{words[i % 7]}_{words[i // 7 % 7]}_{i}.pdf"} for i in range(n)]
+    )
+    start = time.perf_counter()
+    tree.search(query)
+    build = time.perf_counter() - start
+    widget = TreeWidget(tree)
+    start = time.perf_counter()
+    widget.filter(query)
+    return {
+        "nodes": n,
+        "build": build,
+        "search": timeit(lambda: tree.search(query), repeat=5),
+        "filter": time.perf_counter() - start,
+    }
+
+
+# The suite: synthetic trees of several shapes, every operation timed and
+# its peak memory traced, reported as JSON (see `run_suite`)
+
+
+def balanced_nodes(n, fanout=10):
+    """`Tree.to_list()`-style flat nodes: `fanout` children per folder"""
+    nodes = [{"id": str(i), "label": f"node{i}", "children": []} for i in range(n)]
+    for i in range(1, n):
+        nodes[(i - 1) // fanout]["children"].append(str(i))
+    for node in nodes:
+        node["type"] = "folder" if node["children"] else "file"
+    return nodes
+
+
+def chain_nodes(n):
+    """One long path: every node is the only child of the previous one"""
+    return balanced_nodes(n, fanout=1)
+
+
+def wide_nodes(n):
+    """A single folder holding all the other nodes"""
+    return balanced_nodes(n, fanout=max(1, n - 1))
+
+
+def filesystem_nodes(n, seed=0):
+    """
+    Shaped like a source tree: folders of a few subfolders and a
+    long-tailed number of files, a handful of levels deep
+    """
+    rng = random.Random(seed)
+    nodes = [{"id": "0", "label": "project", "type": "folder", "children": []}]
+    folders = [(nodes[0], 0)]
+    while len(nodes) < n:
+        parent, depth = folders[rng.randrange(len(folders))]
+        if depth < 8 and rng.random() < 0.15:
+            label, kind = f"dir{len(nodes)}", "folder"
+        else:
+            kind = rng.choice(["py", "txt", "pdf", "png", "csv"])
+            label = f"file{len(nodes)}.{kind}"
+        node = {"id": str(len(nodes)), "label": label, "type": kind, "children": []}
+        parent["children"].append(node["id"])
+        nodes.append(node)
+        if kind == "folder":
+            folders.append((node, depth + 1))
+    return nodes
+
+
+SHAPES = {
+    "balanced": balanced_nodes,
+    "chain": chain_nodes,
+    "wide": wide_nodes,
+    "filesystem": filesystem_nodes,
+}
+# Operations that cost O(depth) per node make chains of 1e5+ nodes quadratic
+MAX_NODES = {"chain": 10_000}
+
+
+def nest(nodes):
+    """Flat nodes (first one is the top) to `insert_nested_dicts` input"""
+    by_id = {node["id"]: dict(node) for node in nodes}
+    for node in by_id.values():
+        node["children"] = [by_id[c] for c in node["children"]]
+    return [by_id[nodes[0]["id"]]]
+
+
+class CountingComm(BaseComm):
+    """A comm that drops every message after counting it and its size"""
+
+    messages = 0
+    bytes = 0
+
+    def publish_msg(self, msg_type, data=None, metadata=None, buffers=None, **keys):
+        CountingComm.messages += 1
+        CountingComm.bytes += len(json.dumps(data, default=str))
+
+
+@contextmanager
+def mock_comm():
+    """Widgets created inside this block talk to a `CountingComm`"""
+    create_comm = comm.create_comm
+    comm.create_comm = CountingComm
+    try:
+        yield CountingComm
+    finally:
+        comm.create_comm = create_comm
+
+
+def measure(setup, operation, repeat=1):
+    """
+    Seconds (best of `repeat`), traced peak bytes and `CountingComm`
+    traffic of `operation(state)` where `state = setup()` is rebuilt,
+    untimed, before every run
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        operation(state)
+        best = min(best, time.perf_counter() - start)
+    state = setup()
+    messages, size = CountingComm.messages, CountingComm.bytes
+    tracemalloc.start()
+    operation(state)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "seconds": best,
+        "peak_bytes": peak,
+        "comm_messages": CountingComm.messages - messages,
+        "comm_bytes": CountingComm.bytes - size,
+    }
+
+
+def suite_operations(nodes):
+    """{name: (setup, operation)} for a tree made of the flat `nodes`"""
+
+    def tree():
+        return Tree(nodes=copy.deepcopy(nodes))
+
+    def widget():
+        tree = Tree(nodes=copy.deepcopy(nodes))
+        return TreeWidget(tree)
+
+    last = nodes[-1]["id"]
+    first = nodes[0]["id"]
+
+    def move(tree):  # the last node back and forth between two parents
+        for i in range(20):
+            tree.move(last, "root" if i % 2 else first)
+
+    def refresh(widget):  # scroll through the top levels, one page at a time
+        widget.expand_to_level(2)
+        for i in range(0, min(len(widget.viewable_nodes), 20 * widget.height), widget.height):
+            widget.goto_index(i)
+
+    return {
+        "add_multiple": (lambda: copy.deepcopy(nodes), lambda data: Tree(nodes=data)),
+        "insert_nested_dicts": (
+            lambda: (Tree(), nest(nodes)),
+            lambda state: state[0].insert_nested_dicts(state[1]),
+        ),
+        "to_list": (tree, lambda tree: tree.to_list()),
+        "dfs": (tree, lambda tree: sum(1 for _ in tree.dfs())),
+        "bfs": (tree, lambda tree: sum(1 for _ in tree.bfs())),
+        "move": (tree, move),
+        "remove": (tree, lambda tree: tree.remove(first)),
+        "sync": (tree, lambda tree: tree.sync(nodes)),  # nothing changed
+        "widget": (tree, TreeWidget),
+        "refresh": (widget, refresh),
+        "goto_node": (widget, lambda widget: widget.goto_node(last)),
+    }
+
+
+def run_suite(sizes=(1_000, 10_000, 100_000), shapes=tuple(SHAPES), rglob=True):
+    """
+    Time every operation of `suite_operations` on every shape and size
+    (plus `Tree.rglob` over real files). Widget operations also report
+    the comm messages they sent. Returns a JSON-serializable dict.
+    """
+    results = []
+    with mock_comm():
+        for shape in shapes:
+            for n in sizes:
+                if n > MAX_NODES.get(shape, n):
+                    continue
+                nodes = SHAPES[shape](n)
+                repeat = 3 if n <= 10_000 else 1
+                for name, (setup, operation) in suite_operations(nodes).items():
+                    result = measure(setup, operation, repeat)
+                    result.update(shape=shape, nodes=n, operation=name)
+                    results.append(result)
+                    print(
+                        f"{shape:>10} {n:>8} {name:<20} "
+                        f"{result['seconds'] * 1e3:10.3f} ms "
+                        f"{result['peak_bytes'] / 2 ** 20:8.1f} MiB",
+                        file=sys.stderr,
+                    )
+        for n in sizes if rglob else ():
+            if n > 100_000:
+                continue
+            with tempfile.TemporaryDirectory() as root:
+                make_file_tree(root, n)
+                result = measure(Tree, lambda tree: tree.rglob(root, "*.txt"))
+                result.update(shape="disk", nodes=n, operation="rglob")
+                results.append(result)
+
+    return {
+        "meta": {
+            "python": sys.version,
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def compare(old, new):
+    """Print the ratio new/old of the seconds and peak memory of each result"""
+    key = lambda r: (r["shape"], r["nodes"], r["operation"])
+    before = {key(r): r for r in old["results"]}
+    for result in new["results"]:
+        previous = before.get(key(result))
+        if previous is None:
+            continue
+        ratio = lambda field: result[field] / previous[field] if previous[field] else float("nan")
+        print(
+            f"{result['shape']:>10} {result['nodes']:>8} {result['operation']:<20} "
+            f"time x{ratio('seconds'):6.2f}  memory x{ratio('peak_bytes'):6.2f}"
+        )
+
+
+def report():
+    """The quick, human readable timings"""
+    for n in [10_000, 100_000, 1_000_000]:
+        result = bench_expand(n)
+        print(
+            f"{result['nodes']:>8} nodes  "
+            f"expand all: {result['expand']:6.2f} s  "
+            f"collapse all: {result['collapse']:6.2f} s  "
+            f"expand to level 3: {result['expand_to_level'] * 1e3:8.3f} ms"
+        )
+
+    for n in [10_000, 100_000]:
+        result = bench_save(n)
+        print(
+            f"{result['nodes']:>8} nodes  "
+            f"save+load: {result['save_load']:6.2f} s "
+            f"({result['save_load_peak']:5.0f} B/node)  "
+            f"json: {result['json']:6.2f} s ({result['json_peak']:5.0f} B/node)  "
+            f"lazy load: {result['lazy_load'] * 1e3:6.2f} ms"
+        )
+
+    for n in [10_000, 100_000, 1_000_000]:
+        result = bench_search(n)
+        print(
+            f"{result['nodes']:>8} nodes  "
+            f"index: {result['build']:7.2f} s  "
+            f"search: {result['search'] * 1e3:8.3f} ms  "
+            f"filter: {result['filter'] * 1e3:8.3f} ms"
+        )
+
+    for n in [10_000, 100_000, 1_000_000]:
+        result = bench_memory(n)
+        print(
+            f"{result['nodes']:>8} nodes  "
+            f"{result['bytes_per_node']:6.0f} bytes/node  "
+            f"(peak {result['peak_per_node']:6.0f})"
+        )
+
+    result = bench_rglob()
+    print(
+        f"{result['files']:>8} files  "
+        f"legacy rglob: {result['legacy']:7.2f} s  "
+        f"scandir: {result['scandir']:7.2f} s  "
+        f"threaded: {result['threaded']:7.2f} s"
+    )
+
+    for n in [1_000, 10_000, 100_000]:
+        result = bench_visible(n)
+        print(
+            f"{result['nodes']:>8} nodes  "
+            f"open: {result['open'] * 1e3:8.3f} ms  "
+            f"goto_node: {result['goto_node'] * 1e3:8.3f} ms  "
+            f"scroll: {result['scroll'] * 1e3:8.3f} ms"
+        )
+
+    for n in [1_000, 10_000, 100_000, 1_000_000]:
+        result = bench_import(n)
+        print(
+            f"{result['nodes']:>8} nodes  "
+            f"add_multiple: {result['add_multiple'] * 1e3:9.3f} ms  "
+            f"bfs: {result['bfs'] * 1e3:9.3f} ms  "
+            f"({result['add_multiple'] / result['nodes'] * 1e6:.2f} us/node)"
+        )
+
+    for n in [1_000, 10_000, 100_000]:
+        result = bench_move(n)
+        print(
+            f"{result['nodes']:>8} nodes  "
+            f"move: {result['move'] * 1e3:8.3f} ms  "
+            f"full recompute: {result['full_recompute'] * 1e3:8.3f} ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    commands = parser.add_subparsers(dest="command")
+    suite = commands.add_parser("suite", help="run the suite, write JSON")
+    suite.add_argument("-o", "--output", help="JSON file (default: stdout)")
+    suite.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    suite.add_argument("--shapes", nargs="+", choices=list(SHAPES), default=list(SHAPES))
+    suite.add_argument("--no-rglob", action="store_true")
+    compare_runs = commands.add_parser("compare", help="compare two suite runs")
+    compare_runs.add_argument("old")
+    compare_runs.add_argument("new")
+    args = parser.parse_args()
+
+    if args.command == "suite":
+        run = run_suite(args.sizes, args.shapes, rglob=not args.no_rglob)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(run, f, indent=1)
+        else:
+            print(json.dumps(run, indent=1))
+    elif args.command == "compare":
+        with open(args.old) as old, open(args.new) as new:
+            compare(json.load(old), json.load(new))
+    else:
+        report()
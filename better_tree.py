@@ -1,13 +1,28 @@
 # Author: Joel Stansbury
 # Email: stansbury.joel@gmail.com
 
-from pathlib import Path
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, deque, namedtuple
+from collections.abc import MutableSequence
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from fnmatch import fnmatch
+from html import escape
+from itertools import accumulate, chain, count, islice
+from pathlib import Path, PurePath
+import asyncio
+import marshal
+import math
+import mmap
+import os
+import struct
+import sys
 import time
 from uuid import uuid1
 import ipywidgets as ipyw
 from ipyevents import Event
 from traitlets import Unicode, Int, link, observe
-from typing import Union, List
+from typing import Callable, Union, List
 
 
 CSS = ipyw.HTML(
@@ -45,12 +60,26 @@ CSS = ipyw.HTML(
             height: -webkit-fill-available;
             width: 16px;
         }
+        .better-tree-html-row {
+            height: 24px;
+            line-height: 24px;
+            white-space: nowrap;
+            cursor: default;
+        }
+        .better-tree-html-row > span {
+            display: inline-block;
+        }
+        .better-tree-toggle {
+            width: 16px;
+            text-align: center;
+        }
     </style>
     """
 )
 
 
 ICONS = {
+    "loading": "spinner",
     "pdf": "file-pdf",
     "xlsx": "file-excel",
     "xlsm": "file-excel",
@@ -71,23 +100,770 @@ ICONS = {
     "section": "indent",
 }
 
+# Geometry of the `HTMLRows` renderer, in pixels. Must agree with `CSS`.
+ROW_HEIGHT = 24
+INDENT = 12
+TOGGLE_WIDTH = 16
+
+
+class ChildList(MutableSequence):
+    """
+    The child ids of a node with very many children, stored as blocks of
+    at most `2 * BLOCK` ids plus an id -> block map. `remove`, `index`,
+    `insert`, `append` and indexing cost O(BLOCK + n / BLOCK) instead of a
+    scan and memmove of the whole list. Behaves like (and compares equal
+    to) the plain list it replaces, see `Tree._add_child`. The id -> block
+    map costs more than the ids themselves, so it is only built by the
+    first lookup of an id: children that are just appended and iterated
+    (a folder loaded once) go without it.
+    """
+
+    BLOCK = 512
+    THRESHOLD = 2048  # plain lists longer than this are converted
+
+    __slots__ = ("_blocks", "_block_of", "_len", "_numbers")
+
+    def __init__(self, ids=()):
+        self.clear()
+        for id in ids:
+            self.append(id)
+
+    def clear(self):
+        self._blocks = [[]]
+        self._block_of = None  # see `_map`
+        self._len = 0
+        self._numbers = None  # id(block) -> block number, see `_number`
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return chain.from_iterable(self._blocks)
+
+    def __reversed__(self):
+        for block in reversed(self._blocks):
+            yield from reversed(block)
+
+    def __contains__(self, id):
+        return id in self._map()
+
+    def __eq__(self, other):
+        if isinstance(other, (list, ChildList)):
+            return len(self) == len(other) and list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"ChildList({list(self)!r})"
+
+    def _find(self, i):
+        """(block number, offset in block) of position `i`"""
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError("child index out of range")
+        for b, block in enumerate(self._blocks):
+            if i < len(block):
+                return b, i
+            i -= len(block)
+
+    def _split(self, b):
+        block = self._blocks[b]
+        if len(block) > 2 * self.BLOCK:
+            half = block[self.BLOCK :]
+            del block[self.BLOCK :]
+            self._blocks.insert(b + 1, half)
+            self._numbers = None
+            if self._block_of is not None:
+                for id in half:
+                    self._block_of[id] = half
+
+    def _drop_if_empty(self, b):
+        if not self._blocks[b] and len(self._blocks) > 1:
+            del self._blocks[b]
+            self._numbers = None
+
+    def _map(self):
+        """The id -> block map, built on first use"""
+        if self._block_of is None:
+            self._block_of = {id: block for block in self._blocks for id in block}
+        return self._block_of
+
+    def _number(self, block):
+        """Position of `block` in `self._blocks`"""
+        if self._numbers is None:
+            self._numbers = {id(b): n for n, b in enumerate(self._blocks)}
+        return self._numbers[id(block)]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        b, j = self._find(i)
+        return self._blocks[b][j]
+
+    def __setitem__(self, i, id):
+        if isinstance(i, slice):
+            ids = list(self)
+            ids[i] = id
+            self.clear()
+            self.extend(ids)
+            return
+        b, j = self._find(i)
+        block = self._blocks[b]
+        if self._block_of is not None:
+            del self._block_of[block[j]]
+            self._block_of[id] = block
+        block[j] = id
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            ids = list(self)
+            del ids[i]
+            self.clear()
+            self.extend(ids)
+            return
+        b, j = self._find(i)
+        id = self._blocks[b].pop(j)
+        if self._block_of is not None:
+            del self._block_of[id]
+        self._len -= 1
+        self._drop_if_empty(b)
+
+    def insert(self, i, id):
+        if i < 0:
+            i = max(0, i + self._len)
+        if i >= self._len:
+            return self.append(id)
+        b, j = self._find(i)
+        block = self._blocks[b]
+        block.insert(j, id)
+        if self._block_of is not None:
+            self._block_of[id] = block
+        self._len += 1
+        self._split(b)
+
+    def append(self, id):
+        block = self._blocks[-1]
+        block.append(id)
+        if self._block_of is not None:
+            self._block_of[id] = block
+        self._len += 1
+        self._split(len(self._blocks) - 1)
+
+    def remove(self, id):
+        block = self._map().pop(id, None)
+        if block is None:
+            raise ValueError(f"{id} is not a child")
+        block.remove(id)
+        self._len -= 1
+        if not block:
+            self._drop_if_empty(self._number(block))
+
+    def index(self, id, start=0, stop=None):
+        block = self._map().get(id)
+        if block is None:
+            raise ValueError(f"{id} is not a child")
+        b = self._number(block)
+        i = sum(map(len, islice(self._blocks, b))) + block.index(id)
+        if not start <= i < (self._len if stop is None else stop):
+            raise ValueError(f"{id} is not a child in that range")
+        return i
+
+    def count(self, id):
+        return int(id in self._map())
+
+    @property
+    def blocks(self):
+        """The blocks of ids, in order. Do not modify them"""
+        return self._blocks
+
+    def block_of(self, id):
+        return self._map()[id]
+
+
+# Default node ids: unique to this process (uuid1 prefix) plus a counter,
+# about half the size of a uuid1 string and much cheaper to generate
+_ID_PREFIX = uuid1().hex[:12]
+_ID_COUNTER = count()
+
+
+def _new_id():
+    return f"{_ID_PREFIX}{next(_ID_COUNTER):x}"
+
 
 class Node:
+    # No per-node __dict__: at a million nodes the attribute dict alone
+    # costs more than everything else the node holds
+    __slots__ = ("data", "id", "parent", "controller", "level")
+
     def __init__(self, data):
         self.data = data if data else {}
         self.data["children"] = self.data.get("children", [])
-        self.id = self.data.get("id", str(uuid1()))
-        # self.parent = self.data.get("parent", None)
-        self.opened = False
-        self.selected = False
+        if len(self.data["children"]) > ChildList.THRESHOLD:
+            self.data["children"] = ChildList(self.data["children"])
+        if isinstance(self.data.get("type"), str):  # few distinct values
+            self.data["type"] = sys.intern(self.data["type"])
+        self.id = self.data["id"] if "id" in self.data else _new_id()
+        self.parent = None  # id of the parent, set by the Tree
+        self.controller = None
+        self.level = 0
 
     def __repr__(self):
         return self.data["label"]
 
+    @property
+    def expandable(self):
+        """Whether the node is drawn with an open/close toggle"""
+        return bool(self.data["children"])
+
     def to_dict(self):
-        self.data["id"] = self.id
-        self.data["children"] = self.data["children"]
-        return self.data
+        data = dict(self.data)
+        data["id"] = self.id
+        data["children"] = list(self.data["children"])
+        return data
+
+
+class LazyNode(Node):
+    """
+    A node whose children are fetched by `loader(node)` the first time
+    it is opened (see `Tree.load_children`). The loader returns an iterable
+    of node data dicts or `Node`s, which may themselves be `LazyNode`s.
+    """
+
+    __slots__ = ("loader", "loaded")
+
+    def __init__(self, data, loader):
+        super().__init__(data)
+        self.loader = loader
+        self.loaded = False
+
+    @property
+    def expandable(self):
+        return not self.loaded or bool(self.data["children"])
+
+
+class _Reversed:
+    """Compares the other way around, for descending `Tree.sort_by` keys"""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def _sort_function(key, reverse=False):
+    """The function of a child `Node` that `Tree.sort_by(key)` orders by"""
+    if key is None:
+        return None
+    if isinstance(key, str):
+        key = (key,)
+    if callable(key):
+        function = key
+    else:  # missing values go last
+        fields = tuple(key)
+        function = lambda node: [(node.data.get(f) is None, node.data.get(f)) for f in fields]
+    if reverse:
+        return lambda node: _Reversed(function(node))
+    return lambda node: function(node)  # a new function, see `Tree._sort_children`
+
+
+def _increasing_run(values):
+    """Indices of a longest strictly increasing subsequence of `values`"""
+    tails = []  # tails[k]: smallest last value of a run of length k + 1
+    ends = []  # ... and its index
+    previous = []  # index before each value in its best run
+    for i, value in enumerate(values):
+        k = bisect_left(tails, value)
+        if k == len(tails):
+            tails.append(value)
+            ends.append(i)
+        else:
+            tails[k] = value
+            ends[k] = i
+        previous.append(ends[k - 1] if k else None)
+    run = []
+    i = ends[-1] if ends else None
+    while i is not None:
+        run.append(i)
+        i = previous[i]
+    return run[::-1]
+
+
+def _file_type(name):
+    parts = name.split(".")
+    return parts[-1] if len(parts) > 1 else "file"
+
+
+def _scandir(path):
+    """`(path, name, is_dir)` of the entries of a directory, sorted by name"""
+    try:
+        with os.scandir(path) as it:
+            return sorted(
+                (entry.path, entry.name, entry.is_dir(follow_symlinks=False))
+                for entry in it
+            )
+    except OSError:
+        return []
+
+
+def _list_directory(path, cache=None):
+    """
+    `(modification time, _scandir(path))`, or `cache[path]` if the
+    directory was not modified since that earlier result
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns  # before listing, to miss no change
+    except OSError:
+        return None, []
+    cached = cache.get(path) if cache else None
+    if cached is not None and cached[0] == mtime:
+        return cached
+    return mtime, _scandir(path)
+
+
+def _walk(root, workers=None, cache=None):
+    """
+    List every directory beneath `root`. Returns
+    {directory: (modification time, `_scandir`)}.
+
+    workers <int> (None): Number of threads listing directories at the
+        same time. Leave as None to walk on the calling thread.
+    cache <dict> (None): An earlier result. Directories that were not
+        modified since are only stat'ed, not listed again.
+    """
+    listings = {}
+    if not workers:
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            listing = listings[directory] = _list_directory(directory, cache)
+            stack.extend(path for path, _, is_dir in listing[1] if is_dir)
+        return listings
+
+    with ThreadPoolExecutor(workers) as pool:
+        pending = {pool.submit(_list_directory, root, cache): root}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                listing = listings[pending.pop(future)] = future.result()
+                for path, _, is_dir in listing[1]:
+                    if is_dir:
+                        pending[pool.submit(_list_directory, path, cache)] = path
+    return listings
+
+
+def _matcher(root, pattern):
+    """
+    `match(path, name)`: whether the entry at `path` beneath the directory
+    `root` matches the `Path.rglob` `pattern`. Patterns with a separator
+    are matched against the end of the path relative to `root`.
+    """
+    if "**" in pattern:
+        raise ValueError(f"recursive patterns are not supported: {pattern!r}")
+    if "/" not in pattern and os.sep not in pattern:
+        return lambda path, name: fnmatch(name, pattern)
+    if root is None:
+        raise ValueError(f"{pattern!r} has a separator, it needs the search root")
+    start = len(os.path.join(root, ""))
+    return lambda path, name: PurePath(path[start:]).match(pattern)
+
+
+def _rglob_nodes(root, pattern, listings):
+    """
+    The flat nodes of `Tree.rglob`: every match of `pattern` in the
+    `_walk` result `listings`, with the directories leading to them
+    """
+    match = _matcher(root, pattern)
+    # Keep every match and every directory with a match beneath it,
+    # visiting children before their parents (longer paths first)
+    keep = set()
+    for directory in sorted(listings, key=len, reverse=True):
+        for path, name, is_dir in listings[directory][1]:
+            if match(path, name) or path in keep:
+                keep.add(path)
+                keep.add(directory)
+
+    nodes = []
+    stack = [root]
+    while stack:  # pre-order, so the top level is added in order
+        for path, name, is_dir in listings.get(stack.pop(), (None, ()))[1]:
+            if path not in keep:
+                continue
+            children = [c for c, _, _ in listings.get(path, (None, ()))[1] if c in keep]
+            nodes.append(
+                {
+                    "id": path,
+                    "label": name,
+                    "children": children,
+                    "type": "folder" if is_dir else _file_type(name),
+                }
+            )
+            if children:
+                stack.append(path)
+    return nodes
+
+
+def scandir_loader(pattern="*", root=None):
+    """
+    A `LazyNode` loader which lists the directory at `node.data["path"]`
+    with `os.scandir`. Subdirectories become `LazyNode`s with the same
+    loader, files are kept if they match `pattern` (see `Path.rglob`).
+    Patterns with a separator are matched below the directory `root`.
+    """
+    match = _matcher(root, pattern)
+
+    def loader(node):
+        children = []
+        for path, name, is_dir in _scandir(node.data["path"]):
+            data = {"id": path, "label": name, "path": path}
+            if is_dir:
+                data["type"] = "folder"
+                children.append(LazyNode(data, loader))
+            elif match(path, name):
+                data["type"] = _file_type(name)
+                children.append(data)
+        return children
+
+    return loader
+
+
+# The events passed to `Tree.subscribe` callbacks. Positions are indices
+# in the parent's children at the time of the change (None if unknown)
+NodeAdded = namedtuple("NodeAdded", "id parent position")
+NodeRemoved = namedtuple("NodeRemoved", "id parent subtree")  # every removed id
+NodeMoved = namedtuple("NodeMoved", "id old_parent parent position")
+NodeUpdated = namedtuple("NodeUpdated", "id keys")  # the data keys that were set
+# depth: the number of levels that were set, from `id` down (None for all),
+# view: the `TreeWidget` they were opened or closed in
+OpenChanged = namedtuple("OpenChanged", "id opened depth view")
+
+
+def _parents(event):
+    """The ids an event names as parents"""
+    if type(event) is NodeMoved:
+        return (event.old_parent, event.parent)
+    if type(event) is NodeAdded or type(event) is NodeRemoved:
+        return (event.parent,)
+    return ()
+
+
+def _coalesce(events):
+    """
+    Merge a burst of events per node: moves into one move, updates into one
+    update of all the keys, and drop the events of nodes removed later in
+    the burst, unless the listeners saw them or need them as the parent of
+    a node that was moved out first. A removal then lists those nodes only,
+    split where the listeners saw them elsewhere: one per node whose parent
+    (as last seen) is outside the removed subtree. A merged event takes the
+    place of the node's last one.
+    """
+    slots = []  # the events, None where dropped
+    last = {}  # (type, id) -> slot of the node's latest event of that type
+    added = set()  # ids added within the burst
+    named = defaultdict(list)  # id in `added` -> slots of events naming it a parent
+
+    def keep(event):
+        for parent in _parents(event):
+            if parent in added:
+                named[parent].append(len(slots))
+        slots.append(event)
+
+    for event in events:
+        kind = type(event)
+        if kind is NodeRemoved:
+            removed = set(event.subtree)
+            new = removed & added
+            known = set()  # the new nodes that stay: named by a node outside
+            stack = [
+                id
+                for id in new
+                if any(slots[s] and slots[s].id not in removed for s in named[id])
+            ]
+            while stack:  # ... and the parents their own events name
+                id = stack.pop()
+                if id not in known:
+                    known.add(id)
+                    for key in [(NodeAdded, id), (NodeMoved, id)]:
+                        if key in last:
+                            stack.extend(p for p in _parents(slots[last[key]]) if p in new)
+            seen_under = {}  # id -> its parent as the listeners last saw it
+            for id in event.subtree:
+                for key in [(NodeAdded, id), (NodeMoved, id), (NodeUpdated, id)]:
+                    slot = last.pop(key, None)
+                    if slot is None:
+                        continue
+                    if id in known:  # told about, up to its latest parent
+                        if key[0] is not NodeUpdated:
+                            seen_under[id] = slots[slot].parent
+                        continue
+                    if key[0] is NodeMoved:
+                        seen_under[id] = slots[slot].old_parent
+                    slots[slot] = None
+            if event.id not in new or event.id in known:
+                seen_under.setdefault(event.id, event.parent)
+            tops = []  # the nodes seen leaving a parent outside the subtree
+            orphans, groups = [], []  # the seen ids, by top
+            for id in event.subtree:
+                if id in new and id not in known:
+                    continue  # the listeners never saw it
+                parent = seen_under.get(id)
+                if parent is not None and parent not in removed:
+                    tops.append(parent)
+                    groups.append([id])
+                elif groups:
+                    groups[-1].append(id)
+                else:
+                    orphans.append(id)  # below a top found later
+            added -= new
+            for id in new:
+                named.pop(id, None)
+            if groups:
+                groups[0] += orphans
+            for parent, group in zip(tops, groups):
+                keep(NodeRemoved(group[0], parent, tuple(group)))
+            continue
+        elif kind is NodeAdded:
+            added.add(event.id)
+        elif kind is NodeMoved or kind is NodeUpdated:
+            slot = last.get((kind, event.id))
+            if slot is not None:
+                previous, slots[slot] = slots[slot], None
+                if kind is NodeMoved:
+                    event = event._replace(old_parent=previous.old_parent)
+                else:
+                    event = event._replace(keys=tuple(dict.fromkeys(previous.keys + event.keys)))
+        if kind is not OpenChanged:
+            last[(kind, event.id)] = len(slots)
+        keep(event)
+    return [event for event in slots if event is not None]
+
+
+_MISSING = object()  # a data key that was not set, see `Tree._update`
+
+
+class Journal:
+    """
+    The undo/redo history of a `Tree`. Each step is the list of inverse
+    operations of one change (or `batch`): `(method name, *args)` tuples
+    that the tree replays in reverse order. Steps that restore removed
+    subtrees hold on to their nodes, so the history is bounded by `limit`,
+    the number of operations and restorable nodes it may keep. The oldest
+    steps are forgotten first and a step larger than `limit` clears it.
+    """
+
+    def __init__(self, limit: int = 100_000):
+        self.limit = limit
+        self.replaying = None  # "undo" or "redo" while a step is replayed
+        self.paused = 0
+        self.clear()
+
+    def clear(self):
+        self.undo_steps = deque()  # (cost, operations)
+        self.redo_steps = []
+        self.cost = 0
+        self._step = []
+        self._step_cost = 0
+        self._overflow = False
+
+    @contextmanager
+    def pause(self):
+        """Leave the changes made in this block out of the history"""
+        self.paused += 1
+        try:
+            yield
+        finally:
+            self.paused -= 1
+
+    def record(self, cost, operation):
+        if self.paused or self._overflow:
+            return
+        self._step_cost += cost
+        if self._step_cost > self.limit:
+            self._overflow = True
+            self._step = []
+        else:
+            self._step.append(operation)
+
+    def commit(self):
+        """End the current step"""
+        step, cost = self._step, self._step_cost
+        self._step, self._step_cost = [], 0
+        if self._overflow:
+            return self.clear()  # earlier steps cannot be replayed past it
+        if not step:
+            return
+        if self.replaying == "undo":
+            self.redo_steps.append((cost, step))
+        else:
+            if self.replaying is None:  # a new change
+                self.cost -= sum(c for c, _ in self.redo_steps)
+                self.redo_steps = []
+            self.undo_steps.append((cost, step))
+        self.cost += cost
+        while self.cost > self.limit and self.undo_steps:
+            self.cost -= self.undo_steps.popleft()[0]
+
+
+class Stats:
+    """
+    Timings of the hot paths ("phases") of a `Tree` or `TreeWidget`, see
+    `Tree.instrument`. While enabled, each phase is shadowed on the
+    instance by a timing wrapper. Disabled, the wrappers are deleted, so
+    the methods cost exactly what they did before.
+    """
+
+    SAMPLES = 1024  # latest latencies kept per phase, for the percentiles
+
+    def __init__(self, owner, phases, hook=None):
+        """
+        phases <dict>: {method name: (unit, count)} where `count(owner,
+            result)` is how many `unit`s (e.g. "nodes") the call touched,
+            or None if the phase has no count
+        hook <callable> (None): `hook(phase, seconds, count)` after every call
+        """
+        self.owner = owner
+        self.phases = phases
+        self.hook = hook
+        self.reset()
+        for name, (unit, count) in phases.items():
+            setattr(owner, name, self._timed(name, getattr(owner, name), count))
+
+    def reset(self):
+        self.calls = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.samples = defaultdict(lambda: deque(maxlen=self.SAMPLES))
+
+    def _timed(self, name, method, count):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = method(*args, **kwargs)
+            seconds = time.perf_counter() - start
+            n = count(self.owner, result) if count else None
+            self.calls[name] += 1
+            self.seconds[name] += seconds
+            self.samples[name].append(seconds)
+            if n:
+                self.counts[name] += n
+            if self.hook:
+                self.hook(name, seconds, n)
+            return result
+
+        return timed
+
+    def remove(self):
+        for name in self.phases:
+            delattr(self.owner, name)  # uncovers the method again
+
+    def summary(self):
+        """{phase: {"calls", "total", "p50", "p99" (seconds) and its unit}}"""
+        result = {}
+        for name, (unit, count) in self.phases.items():
+            if not self.calls[name]:
+                continue
+            samples = sorted(self.samples[name])
+            result[name] = {
+                "calls": self.calls[name],
+                "total": self.seconds[name],
+                "p50": samples[len(samples) // 2],
+                "p99": samples[min(len(samples) - 1, len(samples) * 99 // 100)],
+            }
+            if count:
+                result[name][unit] = self.counts[name]
+        return result
+
+
+def _instrument(owner, stats, phases, enabled, hook):
+    """Replace the `Stats` of `owner`. Returns the new one (or None)"""
+    if stats is not None:
+        stats.remove()
+    return Stats(owner, phases, hook) if enabled else None
+
+
+# `Tree.save` files: a magic string ending with the marshal format version,
+# then one record per node in pre-order. A record is a header (payload
+# size, number of children, offset just past the node's last descendant)
+# and the node's data without "children", marshalled. marshal is not
+# stable across format versions, so files of another one are refused. The
+# end offsets let `Tree.load(lazy=True)` skip subtrees.
+_SAVE_MAGIC = b"better-tree\x02" + bytes([marshal.version])
+_RECORD = struct.Struct("<IIQ")
+_RECORD_END = struct.Struct("<Q")  # the last field of a _RECORD
+_END_FIELD = _RECORD.size - _RECORD_END.size
+
+
+def _read_records(buffer, position, skip=False):
+    """
+    Yield `(data, n_children, next_position, end)` for the records of a
+    saved tree from `position` on, in pre-order. With `skip`, jump over the
+    subtree of each record instead, i.e. read siblings.
+    """
+    size = len(buffer)
+    header = _RECORD.size
+    while position < size:
+        if position + header > size:
+            raise ValueError(f"truncated Tree.save record at byte {position}")
+        length, n_children, end = _RECORD.unpack_from(buffer, position)
+        start = position + header
+        position = start + length
+        if not start <= position <= end <= size:
+            raise ValueError(f"corrupt Tree.save record at byte {start - header}")
+        data = marshal.loads(buffer[start:position])
+        if type(data) is not dict or "id" not in data:
+            raise ValueError(f"corrupt Tree.save record at byte {start - header}")
+        yield data, n_children, position, end
+        if skip:
+            position = end
+
+
+def _relocated(buffer, start, end, offset):
+    """
+    The records of `buffer[start:end]` with their end offsets moved by
+    `offset`, to be written elsewhere in another file
+    """
+    records = bytearray(buffer[start:end])
+    position = 0
+    while position < len(records):
+        length, _, record_end = _RECORD.unpack_from(records, position)
+        _RECORD_END.pack_into(records, position + _END_FIELD, record_end + offset)
+        position += _RECORD.size + length
+    return records
+
+
+def _saved_loader(buffer):
+    """
+    A `LazyNode` loader over a saved tree mapped into `buffer`. Returns
+    `(loader, read)` where `read(position, n)` builds the `n` sibling
+    records at `position`: nodes with children are `LazyNode`s which
+    remember where their own children start. `loader.saved` is
+    `(buffer, {id: (first child, n children, end)})` for the nodes not
+    loaded yet, so `Tree.save` can copy their subtrees.
+    """
+    pending = {}  # id -> (position, n, end) of the children of unloaded nodes
+
+    def read(position, n):
+        children = []
+        for data, n_children, first_child, end in islice(
+            _read_records(buffer, position, skip=True), n
+        ):
+            if n_children:
+                child = LazyNode(data, loader)
+                pending[child.id] = (first_child, n_children, end)
+                children.append(child)
+            else:
+                children.append(data)
+        return children
+
+    def loader(node):
+        position, n, _ = pending.pop(node.id)
+        return read(position, n)
+
+    loader.saved = (buffer, pending)
+    return loader, read
 
 
 class Tree:
@@ -103,11 +879,24 @@ class Tree:
         self.root.level = 0
         self.registry = {"root": self.root}
         self.listeners = []
-        self.widget = None
+        self.views = []  # the TreeWidgets showing this tree
         self.onchange_todos = []
+        self.subscribers = []  # (callback, event types), see `subscribe`
+        self._events = []  # not yet published, see `_emit`
+        self.last_change = None  # summary of the last change, see `_record`
+        self.search_indexes = {}  # fields -> SearchIndex, see `search`
+        self.sort_keys = {}  # node id (None for every node) -> key, see `sort_by`
+        self._sorted_by = {}  # node id -> the key its children are ordered by
+        self._scan = None  # the last `rglob` directory listings, see `rescan`
+        self._changes = self._new_changes()
+        self._batch_depth = 0
+        self._quiet = 0  # see `_quietly`
+        self.journal = Journal()
+        self._stats = None  # see `instrument`
 
         if nodes:
             self.add_multiple(nodes)
+            self.journal.clear()
 
     def _disown(self, node):
         if node.parent is not None:
@@ -116,13 +905,125 @@ class Tree:
         node.parent = None
 
     def _set_parent(self, node, parent, position=None):
+        position = self._add_child(parent, node.id, position)
+        node.parent = parent.id
+        return position
+
+    def _add_child(self, parent, node_id, position=None):
+        """
+        Append (or insert) `node_id` to `parent`'s children, switching them
+        to a `ChildList` once they grow past `ChildList.THRESHOLD`. If
+        they are sorted (see `sort_by`), `position` is ignored and the
+        node is placed by bisection. Returns its position.
+        """
+        key = self._sort_key(parent)
+        if key is not None:
+            self._sort_children(parent)
+            registry = self.registry
+            position = bisect_right(
+                parent.data["children"],
+                key(registry[node_id]),
+                key=lambda c: key(registry[c]),
+            )
+        children = parent.data["children"]
         if position is None:
-            parent.data["children"].append(node.id)
+            position = len(children)
+            children.append(node_id)
         else:
-            parent.data["children"].insert(position, node.id)
-        node.parent = parent.id
+            children.insert(position, node_id)
+        if type(children) is list and len(children) > ChildList.THRESHOLD:
+            parent.data["children"] = ChildList(children)
+        return position
+
+    def _insert_children(self, parent, position, ids):
+        """
+        Splice `ids` into `parent`'s children before `position`. Returns
+        the position of each at the time it was inserted.
+        """
+        if self._sort_key(parent) is not None:
+            return [self._add_child(parent, node_id) for node_id in ids]
+        children = parent.data["children"]
+        if isinstance(children, ChildList):
+            for offset, node_id in enumerate(ids):
+                children.insert(position + offset, node_id)
+        else:
+            children[position:position] = ids
+            if len(children) > ChildList.THRESHOLD:
+                parent.data["children"] = ChildList(children)
+        return list(range(position, position + len(ids)))
+
+    def _sort_key(self, parent):
+        """The key the children of `parent` are sorted by, if any"""
+        keys = self.sort_keys
+        if not keys:
+            return None
+        return keys.get(parent.id, keys.get(None))
+
+    def _sort_children(self, parent):
+        """
+        Put the children of `parent` in the order of its sort key unless
+        they already are. Returns whether they were reordered
+        """
+        key = self._sort_key(parent)
+        children = parent.data["children"]
+        if key is None or not children or self._sorted_by.get(parent.id) is key:
+            return False
+        self._sorted_by[parent.id] = key
+        registry = self.registry
+        ids = sorted(children, key=lambda c: key(registry[c]))
+        if type(children) is ChildList:
+            parent.data["children"] = ChildList(ids)
+        else:
+            children[:] = ids
+        return True
+
+    def sort_by(
+        self,
+        key: Union[str, tuple, Callable] = None,
+        node: Union[str, Node] = None,
+        reverse: bool = False,
+        lazy: bool = True,
+    ):
+        """
+        Keep children ordered by `key`. Added and moved nodes are placed by
+        bisection (any requested position is ignored).
+
+        key <str | tuple | callable> (None): A data key such as "label", a
+            tuple of them (("type", "label") groups by type, then sorts by
+            label; nodes missing a key go last) or a function of the child
+            `Node`. None stops sorting, leaving the children as they are.
+        node <str | Node> (None): Only for the children of `node`. None for
+            every node that has no key of its own.
+        reverse <bool> (False): Descending order
+        lazy <bool> (True): Reorder only the children of nodes opened in a
+            view now, the others when they are shown or given a child.
+            False reorders the whole tree now.
+        """
+        key = _sort_function(key, reverse)
+        scope = None if node is None else self._handle_type(node).id
+        if key is None:
+            self.sort_keys.pop(scope, None)
+            if not self.sort_keys:
+                self._sorted_by.clear()
+        else:
+            self.sort_keys[scope] = key
+        registry = self.registry
+        if scope is not None:
+            parents = [registry[scope]]
+        elif lazy:
+            opened = set().union(*(view.opened for view in self.views))
+            parents = [registry[id] for id in opened]
+        else:
+            parents = list(registry.values())
+        self._changing()
+        for parent in parents:
+            self._sort_children(parent)
+        for view in self.views:
+            view.viewable_nodes.reset()
+        self._housekeeping([])
 
     def _validate(self):
+        listed = set()
         for id, node in self.registry.items():
             for c in node.data["children"]:
                 assert c in self.registry, f"child {c} of {node} does not exist"
@@ -130,40 +1031,274 @@ class Tree:
                     f"child {self.registry[c]} has a different parent: {self.parent_of(c)}.\n"
                     + f"Should be: {self.registry[id]}"
                 )
+            listed.update(node.data["children"])
 
         for id, node in self.registry.items():
             if id != "root":
-                assert id in self.registry[node.parent].data["children"]
-
-    def _compute_depth(self, node_id="root", level=0):
-        # TODO: Collect some statistics about this. It may actually
-        # be more efficient to recompute the depth for the 20
-        # visible nodes everytime, versus computing all depths
-        # on an alteration
-        node = self.registry[node_id]
-        node.level = level
-        for c in node.data["children"]:
-            self._compute_depth(c, level + 1)
+                # every listed child is listed by its own parent (see above)
+                assert id in listed, f"{node} is missing from its parent's children"
+
+    def _compute_depth(self, node_id="root", level=None):
+        """Set the level of the subtree of `node_id`. Returns its size"""
+        # `Tree.instrument` shows what this costs compared to the rest
+        if level is None:
+            parent = self.parent_of(node_id)
+            level = 0 if parent is None else parent.level + 1
+        size = 0
+        for node, depth in self.traverse(node_id):
+            node.level = level + depth
+            size += 1
+        return size
+
+    PHASES = {
+        "_housekeeping": (None, None),
+        "_compute_depth": ("nodes", lambda tree, size: size),
+        "_do_onchange": (None, None),
+        "_validate": ("nodes", lambda tree, _: len(tree.registry)),
+        "search": ("nodes", lambda tree, ids: len(ids)),
+        "undo": (None, None),
+        "redo": (None, None),
+    }
+
+    def instrument(self, enabled: bool = True, hook: Callable = None):
+        """
+        Start (or stop, and forget) recording the calls, latencies and
+        nodes touched of the hot paths in `PHASES`, see `stats`.
+
+        hook <callable> (None): `hook(phase, seconds, count)`, called after
+            every recorded call, e.g. to forward them to your metrics
+        """
+        self._stats = _instrument(self, self._stats, self.PHASES, enabled, hook)
+
+    def stats(self):
+        """
+        {phase: {"calls", "total", "p50", "p99", "nodes"}} since
+        `instrument` was called, in seconds. Nested phases are included
+        in their callers' times. Empty unless instrumented.
+        """
+        return self._stats.summary() if self._stats else {}
 
     def onchange(self, function):
         self.onchange_todos.append(function)
 
-    def _do_onchange(self):
-        if self.widget:
-            self.widget.compute_visible()
-            # self.widget.refresh()
+    def subscribe(self, callback: Callable[[list], None], *event_types):
+        """
+        Call `callback(events)` after every change with the list of events
+        (`NodeAdded`, `NodeRemoved`, `NodeMoved`, `NodeUpdated`,
+        `OpenChanged`) of `event_types`, or of any type if none are given.
+        The events of a `batch` are delivered once at its end, coalesced
+        (see `_coalesce`).
+        """
+        self.subscribers.append((callback, event_types or None))
+
+    def unsubscribe(self, callback):
+        self.subscribers = [s for s in self.subscribers if s[0] != callback]
+
+    def _emit(self, event_type, *fields):
+        """Queue an event, if anyone is listening"""
+        if self.subscribers:
+            self._events.append(event_type(*fields))
+
+    def _emit_added(self, node, position):
+        """`NodeAdded` for `node` at `position` and then, in pre-order, its subtree"""
+        if not self.subscribers:
+            return
+        stack = [(node, position)]
+        while stack:
+            node, position = stack.pop()
+            self._events.append(NodeAdded(node.id, node.parent, position))
+            children = list(enumerate(node.data["children"]))
+            stack.extend((self.registry[c], i) for i, c in reversed(children))
+
+    @property
+    def widget(self):
+        """The first `TreeWidget` showing this tree (see `views`), or None"""
+        return self.views[0] if self.views else None
+
+    def _publish_events(self):
+        if self._batch_depth or not self._events:
+            return
+        events, self._events = self._events, []
+        if len(events) > 1:
+            events = _coalesce(events)
+        for callback, event_types in list(self.subscribers):
+            if event_types is not None:
+                selected = [e for e in events if isinstance(e, event_types)]
+            else:
+                selected = events
+            if selected:
+                callback(selected)
+
+    def _do_onchange(self, attached=None):
+        for index in self.search_indexes.values():
+            index.update(self.last_change)
+        removed = self.last_change["removed"]
+        if self._sorted_by:
+            for id in removed:
+                self._sorted_by.pop(id, None)
+        for view in self.views:
+            view.opened.difference_update(removed)
+            if attached is None:
+                view.compute_visible()
+            else:
+                view.viewable_nodes.forget(removed)
+                for node in attached:
+                    view._show(node)
+                view._update_slider()
+        if self._quiet:
+            return  # see `_quietly`
         for f in self.onchange_todos:
             f()
+        self._publish_events()
+
+    def _changing(self):
+        """Call before changing the structure, while the views' rows are valid"""
+        for view in self.views:
+            view._pin_selection()
+
+    def _detach(self, node):
+        """
+        Take `node` (and its subtree) out of the views' visible rows
+        before it is disowned. Must be paired with `_housekeeping`.
+        """
+        self._changing()
+        if not self._batch_depth:
+            for view in self.views:
+                view._hide(node)
+
+    @staticmethod
+    def _new_changes():
+        return {"added": set(), "moved": set(), "removed": set(), "updated": set()}
+
+    def _record(self, kind, ids):
+        """
+        Note that the nodes in `ids` were "added", "moved", "removed" or
+        "updated". Published as `self.last_change` by the next `_housekeeping`.
+        Within one change, a node added then removed was never there, and
+        one removed then added again (the same id) was updated.
+        """
+        changes = self._changes
+        if kind == "added" and changes["removed"]:
+            ids = set(ids)
+            replaced = ids & changes["removed"]
+            if replaced:
+                changes["removed"] -= replaced
+                changes["updated"] |= replaced
+                for id in replaced:
+                    self._sorted_by.pop(id, None)  # a new node, see `_do_onchange`
+                ids -= replaced
+        elif kind == "removed" and changes["added"]:
+            ids = set(ids)
+            created = ids & changes["added"]
+            changes["added"] -= created
+            ids -= created
+        changes[kind].update(ids)
+
+    def _publish_changes(self):
+        changes = self._changes
+        registry = self.registry
+        for kind in ("moved", "updated"):  # not those added or removed since
+            changes[kind] = {
+                id for id in changes[kind] - changes["added"] if id in registry
+            }
+        self.last_change = changes
+        self._changes = self._new_changes()
+
+    @contextmanager
+    def batch(self):
+        """
+        Defer all housekeeping (depths, visible rows, onchange callbacks
+        and widget refreshes) until the end of the block, where the tree is
+        validated and recomputed once. `self.last_change` then summarizes
+        everything that changed inside the block.
+
+            with tree.batch():
+                for d in data:
+                    tree.insert(d)
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self._housekeeping()
+            raise
+        self._batch_depth -= 1
+        if not self._batch_depth:
+            self._validate()
+            self._housekeeping()
+
+    @contextmanager
+    def _quietly(self):
+        """
+        Make several changes with their own (incremental) housekeeping, but
+        run the onchange callbacks, publish the events and end the journal
+        step only once, at the end. Unlike `batch`, costs nothing extra for
+        the rest of the tree.
+        """
+        self._quiet += 1
+        try:
+            yield
+        finally:
+            self._quiet -= 1
+            if not self._quiet:
+                self.journal.commit()
+                for f in self.onchange_todos:
+                    f()
+                self._publish_events()
+
+    def _journal(self, method, *args, cost=1):
+        """Record `method(*args)` as the inverse of the change being made"""
+        self.journal.record(cost, (method, *args))
+
+    def undo(self):
+        """Revert the last change (or `batch`). Returns False if there is none"""
+        return self._replay("undo")
+
+    def redo(self):
+        """Make the last undone change again. Returns False if there is none"""
+        return self._replay("redo")
+
+    def _replay(self, direction):
+        journal = self.journal
+        steps = journal.undo_steps if direction == "undo" else journal.redo_steps
+        if not steps:
+            return False
+        cost, operations = steps.pop()
+        journal.cost -= cost
+        journal.replaying = direction
+        try:
+            with self._quietly():
+                for method, *args in reversed(operations):
+                    getattr(self, method)(*args)
+        finally:
+            journal.replaying = None
+        return True
 
     def _set_controller(self):
         for id, node in self.registry.items():
             node.controller = self
 
-    def _housekeeping(self):
+    def _housekeeping(self, attached=None):
+        """
+        attached <list[Node]> (None): The subtrees that were (re)attached
+            by the mutation. Only their depths and visible rows are updated.
+            Leave as None to recompute everything.
+        """
         # self._validate()
         # self._set_controller()
-        self._compute_depth()
-        self._do_onchange()
+        if self._batch_depth:
+            return  # done once at the end of `batch`
+        self._publish_changes()
+        if not self._quiet:
+            self.journal.commit()
+        if attached is None:
+            self._compute_depth()
+        else:
+            for node in attached:
+                self._compute_depth(node.id)
+        self._do_onchange(attached)
 
     def _handle_type(self, node: Union[str, Node, dict], allow_creation=False):
         if isinstance(node, str):
@@ -186,10 +1321,15 @@ class Tree:
         node = self._handle_type(node, allow_creation=True)
         node.controller = self
         assert node.id not in self.registry, "that id is already in use"
+        self._changing()
         self.registry[node.id] = node
+        self._record("added", [node.id])
         if node.parent is None:
             self.move(node.id)  # append to children of 'root'
-        self._housekeeping()
+        else:
+            self._emit(NodeAdded, node.id, node.parent, None)
+            self._journal("remove", node.id)
+            self._housekeeping([node])
 
     def get_depth(self, node):
         node = self._handle_type(node)
@@ -205,25 +1345,30 @@ class Tree:
 
         every node in `node_list` is required to have a 'children' attribute
         """
+        self._changing()
         parent = self._handle_type(parent)
         node_list = [self._handle_type(node, allow_creation=True) for node in node_list]
+        # The root of an exported tree (`Tree.to_list()`) is merged into `parent`
+        node_list = [node for node in node_list if node is not self.root]
 
-        ids = set([x.id for x in node_list])
-        children = set(sum([x.data["children"] for x in node_list], []))
-        orphans = ids - children
-
-        for n in node_list:  # preserve the order of node_list
-            if n.id in orphans:
-                parent.data["children"].append(n.id)
+        ids = [x.id for x in node_list]
+        children = set(chain.from_iterable(x.data["children"] for x in node_list))
 
+        orphans = [n for n in node_list if n.id not in children]
         for node in node_list:
             node.parent = parent.id
             node.controller = self
             self.registry[node.id] = node
+        # preserve the order of node_list
+        positions = [self._add_child(parent, n.id) for n in orphans]
 
-        for id, node in self.registry.items():
+        for node in node_list:
             for c in node.data["children"]:
-                self.registry[c].parent = id
+                self.registry[c].parent = node.id
+        self._record("added", ids)
+        for node, position in zip(orphans, positions):
+            self._emit_added(node, position)
+            self._journal("remove", node.id)
         self._housekeeping()
 
     def move(
@@ -243,9 +1388,21 @@ class Tree:
         """
         node = self._handle_type(node)
         parent = self._handle_type(parent)
+        old_parent = node.parent
+        if old_parent is None:  # from `add_node`
+            self._journal("remove", node.id)
+        else:
+            old_position = self.registry[old_parent].data["children"].index(node.id)
+            self._journal("move", node.id, old_parent, old_position)
+        self._detach(node)
         self._disown(node)
-        self._set_parent(node, parent, position)
-        self._housekeeping()
+        position = self._set_parent(node, parent, position)
+        self._record("moved", [node.id])
+        if old_parent is None:  # from `add_node`
+            self._emit(NodeAdded, node.id, parent.id, position)
+        else:
+            self._emit(NodeMoved, node.id, old_parent, parent.id, position)
+        self._housekeeping([node])
 
     def _insert_nested_dict(
         self,
@@ -253,23 +1410,36 @@ class Tree:
         parent_id: str = "root",
         children_key: str = "children",
     ):
+        """Returns the node made of `node_data` itself"""
+        nodes = self._iter_insert_nested_dict(node_data, parent_id, children_key)
+        top = next(nodes)
+        deque(nodes, 0)
+        return top
+
+    def _iter_insert_nested_dict(self, node_data, parent_id, children_key):
+        """`_insert_nested_dict`, yielding each node once it is in the tree"""
         # node_data['parent'] = parent_id
-        if children_key in node_data:
-            children_list = node_data.pop(children_key)
-        else:
-            children_list = []
-        node_data["children"] = []
-        node = Node(node_data)  # get or create node.id
-        node.parent = parent_id
-        node.controller = self
-        self.registry[parent_id].data["children"].append(node.id)
-        self.registry[node.id] = node
-        for child in children_list:
-            self._insert_nested_dict(
-                child,
-                parent_id=node.id,
-                children_key=children_key,
-            )
+        stack = [(node_data, parent_id)]
+        top = True  # undone by removing it, with the rest of its subtree
+        while stack:
+            node_data, parent_id = stack.pop()
+            if children_key in node_data:
+                children_list = node_data.pop(children_key)
+            else:
+                children_list = []
+            node_data["children"] = []
+            node = Node(node_data)  # get or create node.id
+            node.parent = parent_id
+            node.controller = self
+            self.registry[node.id] = node
+            position = self._add_child(self.registry[parent_id], node.id)
+            self._record("added", [node.id])
+            self._emit(NodeAdded, node.id, parent_id, position)
+            if top:
+                self._journal("remove", node.id)
+                top = False
+            stack.extend((child, node.id) for child in reversed(children_list))
+            yield node
 
     def insert_nested_dicts(
         self,
@@ -279,59 +1449,396 @@ class Tree:
     ):
         if parent_id is None:
             parent_id = self.root.id
-        for node_data in node_data_list:
+        self._changing()
+        tops = [
             self._insert_nested_dict(
                 node_data=node_data, children_key=children_key, parent_id=parent_id
             )
-        self._housekeeping()
+            for node_data in node_data_list
+        ]
+        self._housekeeping(tops)
+
+    async def ainsert_nested_dicts(
+        self,
+        node_data_list: List[dict],
+        parent_id: str = None,
+        children_key: str = "children",
+        chunk_size: int = 10_000,
+    ):
+        """
+        `insert_nested_dicts` in chunks of `chunk_size` nodes, letting the
+        event loop run in between. The widget shows each chunk as soon as
+        it is in, so start it with `asyncio.ensure_future(...)` to keep
+        the notebook usable meanwhile. Do not remove the nodes being
+        filled in before it is done. Undone as a single step.
+        """
+        if parent_id is None:
+            parent_id = self.root.id
+        nodes = chain.from_iterable(
+            self._iter_insert_nested_dict(node_data, parent_id, children_key)
+            for node_data in node_data_list
+        )
+        tops = []
+        while True:
+            self._changing()
+            with self.journal.pause():  # journaled once, at the end
+                chunk = list(islice(nodes, chunk_size))
+                if not chunk:
+                    break
+                tops += [node.id for node in chunk if node.parent == parent_id]
+                self._publish_chunk(chunk)
+            await asyncio.sleep(0)
+        self._journal_load(tops)
+
+    def _journal_load(self, ids):
+        """Journal the nodes `ids` added by an async load as one step"""
+        self._journal("_remove_all", ids, cost=len(ids))
+        self._housekeeping([])  # ends the step
+
+    def _remove_all(self, ids):
+        """Remove the nodes `ids` that are left, with their subtrees"""
+        for id in ids:
+            if id in self.registry:
+                self.remove(id)
+
+    def _publish_chunk(self, nodes):
+        """Housekeeping for newly added `nodes`, attaching the topmost ones"""
+        ids = {node.id for node in nodes}
+        self._housekeeping([node for node in nodes if node.parent not in ids])
 
     def insert(self, node_data, parent_id="root"):
         node = Node(node_data)
-        node.opened = True
         node.controller = self
         assert node.id not in self.registry
         assert parent_id in self.registry
+        self._changing()
         self.registry[node.id] = node
+        for view in self.views:  # so that its future children are shown
+            view.opened.add(node.id)
         node.parent = parent_id
-        self.registry[parent_id].data["children"].append(node.id)
-        self._housekeeping()
+        position = self._add_child(self.registry[parent_id], node.id)
+        self._record("added", [node.id])
+        self._emit(NodeAdded, node.id, parent_id, position)
+        self._journal("remove", node.id)
+        self._housekeeping([node])
         return node
 
+    def update(self, node: Union[str, Node], **data):
+        """
+        Change (or add) entries of a node's data, e.g.
+        `tree.update(node_id, label="new name")`
+        """
+        assert "children" not in data, "use move/insert/remove for children"
+        self._update(node, data)
+
+    def _update(self, node, data):
+        """`update`, where a `_MISSING` value deletes the key"""
+        node = self._handle_type(node)
+        self._journal("_update", node.id, {k: node.data.get(k, _MISSING) for k in data})
+        for key, value in data.items():
+            if value is _MISSING:
+                node.data.pop(key, None)
+            else:
+                node.data[key] = value
+        self._record("updated", [node.id])
+        self._emit(NodeUpdated, node.id, tuple(data))
+        self._keep_sorted(node)
+        self._housekeeping([])
+
+    def _keep_sorted(self, node):
+        """Move `node` to its place if an update put it out of order"""
+        parent = self.parent_of(node)
+        key = None if parent is None else self._sort_key(parent)
+        if key is None or self._sorted_by.get(parent.id) is not key:
+            return  # not sorted yet, see `_sort_children`
+        registry, children = self.registry, parent.data["children"]
+        i = children.index(node.id)
+        value = key(node)
+        if (i and value < key(registry[children[i - 1]])) or (
+            i + 1 < len(children) and key(registry[children[i + 1]]) < value
+        ):
+            self.move(node, parent)
+
+    def search(self, query: str, prefix: bool = False, fields=("label",)):
+        """
+        Ids of the nodes whose label (or any of the data `fields`) contains
+        `query`, or starts with it if `prefix`. Case insensitive. The first
+        search over some `fields` builds a `SearchIndex`, which is then kept
+        up to date as the tree changes.
+        """
+        fields = tuple(fields)
+        index = self.search_indexes.get(fields)
+        if index is None:
+            index = self.search_indexes[fields] = SearchIndex(self, fields)
+        return index.search(query, prefix)
+
+    def bulk_insert(self, node_data_list: List[dict], parent_id: str = "root"):
+        """
+        `Tree.insert` each of `node_data_list` beneath `parent_id`
+        inside a single `Tree.batch`. Returns the new nodes.
+        """
+        with self.batch():
+            with self.journal.pause():  # one list of ids, not a tuple per node
+                nodes = [self.insert(node_data, parent_id) for node_data in node_data_list]
+            self._journal("_remove_all", [node.id for node in nodes], cost=len(nodes))
+        return nodes
+
     def remove(self, node: Union[str, Node], recursive: bool = True):
+        """
+        params:
+            recursive <bool> (True): Remove the whole subtree of `node`.
+                If False, its children take its place in its parent.
+        """
         node = self._handle_type(node)
+        self._detach(node)
         if recursive:  # remove children from registry
-            for c in list(self.dfs(node.id)):
-                self.registry.pop(c.id)
-        else:  # move children up
-            for c in node.data["children"]:
-                self.move(c, node.parent)
-
-        # remove from parent's children
-        self._disown(node)
-        self._housekeeping()
+            if node.parent is not None:
+                position = self.registry[node.parent].data["children"].index(node.id)
+            nodes = self._free(node)
+            if node.parent is not None:
+                self._journal("_restore", node.parent, position, nodes, cost=len(nodes))
+            removed = [n.id for n in nodes]
+            self._record("removed", removed)
+            self._emit(NodeRemoved, node.id, node.parent, tuple(removed))
+            self._disown(node)
+            self._housekeeping([])
+        else:  # lift the children into node's place, in one splice
+            parent = self.parent_of(node)
+            children = list(node.data["children"])
+            position = parent.data["children"].index(node.id)
+            for c in children:  # replayed in reverse: the last child first
+                self._journal("move", c, node.id, 0)
+            self._journal("_restore", parent.id, position, [node])
+            self._disown(node)
+            positions = self._insert_children(parent, position, children)
+            for c in children:
+                self.registry[c].parent = parent.id
+            node.data["children"] = []
+            self.registry.pop(node.id)
+            self._record("removed", [node.id])
+            self._record("moved", children)
+            self._emit(NodeRemoved, node.id, parent.id, (node.id,))
+            for c, position in zip(children, positions):
+                self._emit(NodeMoved, c, node.id, parent.id, position)
+            self._housekeeping([self.registry[c] for c in children])
 
     def remove_children(self, node: Union[str, Node]):
         node = self._handle_type(node)
-        for c in list(self.dfs(node.id))[1:]:
-            self.registry.pop(c.id)
+        self._detach(node)
+        removed = []
+        for c in node.data["children"]:
+            nodes = self._free(self.registry[c])
+            self._journal("_restore", node.id, 0, nodes, cost=len(nodes))
+            subtree = [n.id for n in nodes]
+            self._emit(NodeRemoved, c, node.id, tuple(subtree))
+            removed += subtree
+        self._record("removed", removed)
         node.data["children"] = []
-        self._housekeeping()
+        self._housekeeping([node])
+
+    def _free(self, node):
+        """Drop the subtree of `node` from the registry. Returns its nodes"""
+        registry = self.registry
+        removed = []
+        for n, _ in self.traverse(node.id):  # n's children are already queued
+            del registry[n.id]
+            removed.append(n)
+        return removed
+
+    def _restore(self, parent_id, position, nodes):
+        """Put back a subtree taken out by `remove` (`nodes`, top first)"""
+        self._changing()
+        node = nodes[0]
+        for n in nodes:
+            self.registry[n.id] = n
+        position = self._set_parent(node, self.registry[parent_id], position)
+        self._record("added", [n.id for n in nodes])
+        self._emit_added(node, position)
+        self._journal("remove", node.id)
+        self._housekeeping([node])
+
+    def sync(self, nodes: List[Union[Node, dict]]):
+        """
+        Make the tree equal to `nodes` (a flat list as for `Tree(nodes=...)`,
+        every node with an id) with as few changes as possible: nodes are
+        matched by id, new ones added, missing ones removed, those with
+        another parent or out of order moved and changed data updated.
+        Applied as one transaction (one undo step, one refresh), so the
+        views keep their open nodes, selection and scroll position.
+        Returns the ids that were "added", "removed", "moved" and
+        "updated", like `last_change`.
+        """
+        new = {}
+        for node in nodes:
+            data = node.to_dict() if isinstance(node, Node) else node
+            new[data["id"]] = data
+        root = new.pop("root", None)  # as exported by `to_list`
+        top = list(root.get("children", ())) if root else []
+        listed = set(chain.from_iterable(data.get("children", ()) for data in new.values()))
+        listed.update(top)
+        top += [id for id in new if id not in listed]
+
+        registry = self.registry
+        added = [id for id in new if id not in registry]
+        gone = registry.keys() - new.keys() - {"root"}
+        summary = {"added": set(added), "removed": gone, "moved": set(), "updated": set()}
+        # Many changes: one recompute at the end. Few: incremental housekeeping
+        large = len(added) + len(gone) > len(registry) // 16
+        with self.batch() if large else self._quietly():
+            stack = [(self.root, top)]
+            while stack:  # parents before their children
+                parent, ids = stack.pop()
+                if ids or parent.data["children"]:
+                    summary["moved"].update(self._sync_children(parent, ids, new))
+                    stack.extend((registry[id], new[id].get("children", [])) for id in ids)
+            for id in [id for id in gone if registry[id].parent not in gone]:
+                self.remove(id)
+            for id, data in new.items():
+                if id not in summary["added"] and self._sync_data(registry[id], data):
+                    summary["updated"].add(id)
+            if root and self._sync_data(self.root, root):
+                summary["updated"].add("root")
+        return summary
+
+    def _sync_children(self, parent, ids, new):
+        """
+        Add and move nodes so that the children of `parent` are `ids`.
+        Returns the ids of the nodes that were moved.
+        """
+        registry = self.registry
+        if parent.data["children"] == ids:
+            return []
+        moved = []
+        if self._sort_key(parent) is not None:  # only the parent matters
+            for id in ids:
+                if id not in registry:
+                    self._sync_add(parent, new[id], None)
+                elif registry[id].parent != parent.id:
+                    self.move(id, parent)
+                    moved.append(id)
+            return moved
+        wanted = {id: i for i, id in enumerate(ids)}
+        staying = [c for c in parent.data["children"] if c in wanted]
+        if staying == ids:
+            return moved
+        # the longest run of staying children already in order is left alone
+        run = _increasing_run([wanted[c] for c in staying])
+        keep = {staying[i] for i in run}
+        cursor = 0  # where the next id goes
+        for id in ids:
+            children = parent.data["children"]
+            if id in keep:
+                cursor = children.index(id) + 1
+            elif id not in registry:
+                self._sync_add(parent, new[id], cursor)
+                cursor += 1
+            elif registry[id].parent == parent.id and children.index(id) < cursor:
+                self.move(id, parent, cursor - 1)  # the cursor moves back by one
+                moved.append(id)
+            else:
+                self.move(id, parent, cursor)
+                moved.append(id)
+                cursor += 1
+        return moved
+
+    def _sync_add(self, parent, data, position):
+        """Add a node made of `data` without its children (see `sync`)"""
+        node = Node(dict(data, children=[]))
+        node.controller = self
+        self._changing()
+        self.registry[node.id] = node
+        position = self._set_parent(node, parent, position)
+        self._record("added", [node.id])
+        self._emit(NodeAdded, node.id, parent.id, position)
+        self._journal("remove", node.id)
+        self._housekeeping([node])
+
+    def _sync_data(self, node, data):
+        """Update the data of `node` to `data`. Returns whether it changed"""
+        if node.data == data:
+            return False
+        changes = {
+            key: value
+            for key, value in data.items()
+            if key not in ("id", "children") and node.data.get(key, _MISSING) != value
+        }
+        for key in node.data:
+            if key not in data and key not in ("id", "children"):
+                changes[key] = _MISSING
+        if changes:
+            self._update(node, changes)
+        return bool(changes)
 
     def bfs(self, node_ids: Union[str, List[str]] = "root"):
         if isinstance(node_ids, str):
             node_ids = [node_ids]
-        for c in node_ids:
-            yield self.registry[c]
-        next_ids = sum(
-            [self.registry[node_id].data["children"] for node_id in node_ids], []
-        )
-        if next_ids:
-            yield from self.bfs(next_ids)
+        queue = deque(node_ids)
+        while queue:
+            node = self.registry[queue.popleft()]
+            yield node
+            queue.extend(node.data["children"])
+
+    def traverse(
+        self,
+        node_id: str = "root",
+        order: str = "pre",
+        max_depth: int = None,
+        prune: Callable[[Node], bool] = None,
+    ):
+        """
+        Walk the subtree of `node_id` without recursion, yielding
+        `(node, depth)` pairs where depth is relative to `node_id`.
+
+        params:
+            order <str> ("pre"): "pre", "post" or "level"
+            max_depth <int> (None): Do not descend below this depth
+            prune <callable> (None): `prune(node) -> bool`. The children of
+                nodes for which this returns True are skipped (the node
+                itself is still yielded)
+        """
+        registry = self.registry
+
+        def descend(node, depth):
+            if max_depth is not None and depth >= max_depth:
+                return False
+            return not (prune and prune(node))
+
+        start = registry[node_id]
+        if order == "pre":
+            stack = [(start, 0)]
+            while stack:
+                node, depth = stack.pop()
+                yield node, depth
+                if descend(node, depth):
+                    stack.extend(
+                        (registry[c], depth + 1) for c in reversed(node.data["children"])
+                    )
+        elif order == "post":
+            stack = [(start, 0, False)]
+            while stack:
+                node, depth, expanded = stack.pop()
+                if expanded:
+                    yield node, depth
+                    continue
+                stack.append((node, depth, True))
+                if descend(node, depth):
+                    stack.extend(
+                        (registry[c], depth + 1, False)
+                        for c in reversed(node.data["children"])
+                    )
+        elif order == "level":
+            queue = deque([(start, 0)])
+            while queue:
+                node, depth = queue.popleft()
+                yield node, depth
+                if descend(node, depth):
+                    queue.extend((registry[c], depth + 1) for c in node.data["children"])
+        else:
+            raise ValueError(f"unknown traversal order: {order}")
 
     def dfs(self, node_id: str = "root"):
-        yield self.registry[node_id]
-        for c in self.registry[node_id].data["children"]:
-            yield from self.dfs(c)
+        for node, _ in self.traverse(node_id):
+            yield node
 
     def to_list(self, node_id: str = "root"):
         result = []
@@ -342,42 +1849,799 @@ class Tree:
             result.append(d)
         return result
 
-    def rglob(self, root, pattern):
+    def save(self, path, node_id: str = "root"):
         """
-        Constructs a tree from an rglob search
+        Write the subtree of `node_id` to `path`, one record per node and
+        without building it in memory first (see `Tree.load`). Unopened
+        `LazyNode`s of a lazily loaded file are copied from it with their
+        subtrees, those of other loaders are written without children.
+        The file is written beside `path` and then moved over it, so it
+        may be the file the tree was loaded from, and is left as it was if
+        saving fails. Data values must be supported by `marshal` (None,
+        bools, numbers, strings, bytes and containers of them), others
+        raise a ValueError.
+        """
+        temporary = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary, "w+b") as f:
+                self._write(f, node_id)
+            os.replace(temporary, path)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    def _write(self, f, node_id):
+        f.write(_SAVE_MAGIC)
+        position = len(_SAVE_MAGIC)
+        ancestors = []  # (header position, saved children to copy) still open
+        ends = []  # (header position, end) of records with children
+
+        def close():
+            nonlocal position
+            header, copy = ancestors.pop()
+            if copy:  # after the children it was given since it was loaded
+                buffer, first_child, end = copy
+                f.write(_relocated(buffer, first_child, end, position - first_child))
+                position += end - first_child
+            ends.append((header, position))
+
+        for node, depth in self.traverse(node_id):
+            while len(ancestors) > depth:
+                close()
+            data = {k: v for k, v in node.data.items() if k != "children"}
+            data["id"] = node.id
+            try:
+                payload = marshal.dumps(data, marshal.version)
+            except ValueError as e:
+                raise ValueError(f"cannot save the data of {node}: {e}") from None
+            n_children = len(node.data["children"])
+            copy = None
+            saved = isinstance(node, LazyNode) and getattr(node.loader, "saved", None)
+            if saved and not node.loaded and node.id in saved[1]:
+                buffer, pending = saved
+                first_child, n_saved, end = pending[node.id]
+                n_children += n_saved
+                copy = (buffer, first_child, end)
+            if n_children:
+                ancestors.append((position, copy))
+            position += _RECORD.size + len(payload)
+            f.write(_RECORD.pack(len(payload), n_children, position))
+            f.write(payload)
+        while ancestors:
+            close()
+        f.flush()
+        if not ends:
+            return
+        with mmap.mmap(f.fileno(), 0) as buffer:
+            for start, end in ends:
+                _RECORD_END.pack_into(buffer, start + _END_FIELD, end)
+
+    @classmethod
+    def load(cls, path, lazy: bool = False):
+        """
+        Build a tree from a `Tree.save` file in a single pass. A saved
+        "root" becomes the new root, any other node goes beneath it.
+        Records are decoded with `marshal`, which is not secure against
+        erroneous or malicious data: only load files you trust. Sizes and
+        offsets are checked, so truncated or damaged files raise a
+        ValueError.
+
+        lazy <bool> (False): Memory-map the file and only read the top
+            level now. Nodes with children are `LazyNode`s whose children
+            are read from the file when they are first opened.
+        """
+        tree = cls()
+        with open(path, "rb") as f:
+            magic = f.read(len(_SAVE_MAGIC))
+            if magic[:-1] != _SAVE_MAGIC[:-1]:
+                raise ValueError(f"{path} was not written by Tree.save")
+            if magic != _SAVE_MAGIC:
+                raise ValueError(
+                    f"{path} holds marshal format {magic[-1]}, "
+                    f"this Python reads format {marshal.version}"
+                )
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        position = len(_SAVE_MAGIC)
+
+        if lazy:
+            loader, read = _saved_loader(buffer)
+            data, n_children, first_child, _ = next(_read_records(buffer, position))
+            if data["id"] == "root":
+                tree.root.data.update(data)
+                tree._adopt(tree.root, read(first_child, n_children))
+            else:
+                tree._adopt(tree.root, read(position, 1))
+            tree.journal.clear()
+            return tree
+
+        registry = tree.registry
+        parents = [tree.root]
+        remaining = [1]  # number of children left to read, per parent
+        for data, n_children, _, _ in _read_records(buffer, position):
+            while not remaining[-1]:
+                parents.pop()
+                remaining.pop()
+                if not remaining:
+                    raise ValueError(f"{path} holds more records than its nodes list")
+            remaining[-1] -= 1
+            if data["id"] == "root":
+                node = tree.root
+                node.data.update(data)
+            else:
+                node = Node(data)
+                node.parent = parents[-1].id
+                node.controller = tree
+                tree._add_child(parents[-1], node.id)
+                registry[node.id] = node
+            if n_children:
+                parents.append(node)
+                remaining.append(n_children)
+        buffer.close()
+        tree._record("added", islice(registry, 1, None))
+        tree._housekeeping()
+        return tree
+
+    def load_children(self, node: Union[str, Node]):
+        """
+        Fetch the children of a `LazyNode` from its loader. Does nothing if
+        they were already loaded or if `node` is not lazy.
+        """
+        node = self._handle_type(node)
+        if not isinstance(node, LazyNode) or node.loaded:
+            return
+        children = list(node.loader(node))  # if it raises, it can be retried
+        node.loaded = True
+        with self.journal.pause():  # not an edit, cannot be redone
+            self._adopt(node, children)
+
+    def _adopt(self, parent, children):
+        """Register new `children` (nodes or data dicts) beneath `parent`"""
+        children = [self._handle_type(c, allow_creation=True) for c in children]
+        self._changing()
+        for child in children:
+            assert child.id not in self.registry, "that id is already in use"
+            child.controller = self
+            self.registry[child.id] = child
+            position = self._set_parent(child, parent)
+            self._emit(NodeAdded, child.id, parent.id, position)
+        self._journal("_remove_all", [child.id for child in children], cost=len(children))
+        self._record("added", [child.id for child in children])
+        self._housekeeping(children)
+
+    def rglob(self, root, pattern, lazy=False, workers=None):
+        """
+        Constructs a tree from an rglob search. `pattern` is matched
+        like `Path.rglob` does: against the names, or if it contains a
+        separator against the end of the paths relative to `root`.
+        Recursive ("**") patterns raise a ValueError.
+
+        lazy <bool> (False): Only list `root` now. Its subdirectories are
+            `LazyNode`s read one at a time (`scandir_loader`) when they are
+            first opened, so every directory is shown whether or not it
+            contains a match.
+        workers <int> (None): List directories on this many threads
+            (see `_walk`), which helps on high-latency filesystems.
         """
         root = Path(root)
-        skip = len(root.parts)
-        self.registry = {"root": self.root}
+        loader = scandir_loader(pattern, str(root))  # checks `pattern`
+        self._scan = None
+        self.remove_children("root")
         self.root.data["label"] = str(root)
         self.root.data["type"] = "folder"
+        self.root.data["path"] = str(root)
+        self._emit(NodeUpdated, "root", ("label", "type", "path"))
+
+        if lazy:
+            self._adopt(self.root, loader(self.root))
+            return
+
+        listings = _walk(str(root), workers)
+        self._remember_scan(str(root), pattern, listings)
+        self.add_multiple(_rglob_nodes(str(root), pattern, listings))
+
+    def _remember_scan(self, root, pattern, listings):
+        """Keep what `rescan` needs of the `_walk` of an `rglob`"""
+        match = _matcher(root, pattern)
+        self._scan = (
+            root,
+            pattern,
+            {
+                directory: (mtime, [e for e in entries if e[2] or match(e[0], e[1])])
+                for directory, (mtime, entries) in listings.items()
+            },
+        )
 
-        nodes = {"children": []}
-        for p in list(root.rglob(pattern)):
-            cursor = nodes
-            _id = root
-            for part in p.parts[skip:]:
-                _id = _id / part
-                if not part in [x["label"] for x in cursor["children"]]:
-                    _type = "folder"
-                    if len(part.split(".")) > 1:
-                        _type = part.split(".")[-1]
-                    cursor["children"].append(
+    def rescan(self, workers: int = None):
+        """
+        Bring a tree made by `rglob` (not lazy) up to date with the disk
+        through `sync`, so its views keep their open nodes, selection and
+        scroll position. Only directories modified since the last scan
+        are listed again, the others are just stat'ed. Returns the ids
+        that changed, see `sync`.
+        """
+        if self._scan is None:
+            raise ValueError("rescan needs a tree made by rglob(lazy=False)")
+        root, pattern, cache = self._scan
+        listings = _walk(root, workers, cache)
+        self._remember_scan(root, pattern, listings)
+        return self.sync(_rglob_nodes(root, pattern, listings))
+
+    async def rglob_async(self, root, pattern, chunk_size: int = 10_000):
+        """
+        `rglob` without blocking the event loop: directories are listed
+        on a worker thread and the matches are added in chunks of
+        `chunk_size` entries as they are found, in the same order as
+        `rglob`. See `ainsert_nested_dicts` for how to run it. Undone
+        as a single step.
+        """
+        root = Path(root)
+        match = _matcher(str(root), pattern)
+        self._scan = None
+        self.remove_children("root")
+        self.root.data["label"] = str(root)
+        self.root.data["type"] = "folder"
+        self.root.data["path"] = str(root)
+        self._emit(NodeUpdated, "root", ("label", "type", "path"))
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        def walk():  # every entry beneath `root` in pre-order, in chunks
+            chunk = []
+            stack = [iter(_scandir(str(root)))]
+            while stack:
+                entry = next(stack[-1], None)
+                if entry is None:
+                    stack.pop()
+                    continue
+                chunk.append(entry)
+                if entry[2]:
+                    stack.append(iter(_scandir(entry[0])))
+                if len(chunk) == chunk_size:
+                    loop.call_soon_threadsafe(queue.put_nowait, chunk)
+                    chunk = []
+            loop.call_soon_threadsafe(queue.put_nowait, chunk)
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+        walker = loop.run_in_executor(None, walk)
+        top = str(root)
+        tops = []  # journaled once, at the end
+        while True:
+            entries = await queue.get()
+            if entries is None:
+                break
+            self._changing()
+            added = []
+            for entry in entries:
+                if not match(entry[0], entry[1]) or entry[0] in self.registry:
+                    continue
+                missing = [entry]  # with the ancestors that were not added yet
+                directory = os.path.dirname(entry[0])
+                while directory != top and directory not in self.registry:
+                    missing.append((directory, os.path.basename(directory), True))
+                    directory = os.path.dirname(directory)
+                parent = self.root if directory == top else self.registry[directory]
+                for path, name, is_dir in reversed(missing):
+                    node = Node(
                         {
-                            "id": str(_id),
-                            "label": part,
-                            "children": [],
-                            "type": _type,
+                            "id": path,
+                            "label": name,
+                            "type": "folder" if is_dir else _file_type(name),
                         }
                     )
-                cursor = [x for x in cursor["children"] if x["label"] == part][0]
-        self.insert_nested_dicts(nodes["children"])
+                    node.controller = self
+                    self.registry[path] = node
+                    position = self._set_parent(node, parent)
+                    self._emit(NodeAdded, path, parent.id, position)
+                    if parent is self.root:
+                        tops.append(path)
+                    added.append(node)
+                    parent = node
+            if added:
+                self._record("added", [node.id for node in added])
+                self._publish_chunk(added)
+        await walker
+        self._journal_load(tops)
 
     def __repr__(self, node_id: str = "root", level=0):
-        collector = f"{' '*level}{self.registry[node_id]}\n"
-        for c in self.registry[node_id].data["children"]:
-            collector += self.__repr__(c, level + 1)
-        return collector
+        return "".join(
+            f"{' ' * (level + depth)}{node}\n"
+            for node, depth in self.traverse(node_id)
+        )
+
+
+class VisibleIndex:
+    """
+    The rows of a `TreeWidget`, i.e. the pre-order listing of every node
+    whose ancestors are all in `opened` (the ids of the nodes opened in
+    that widget), without materializing that list.
+
+    Each opened node caches the number of visible rows in its subtree and
+    each parent caches the running totals of its children's sizes, so
+    `index[i]` and `index.index(node)` cost O(depth * log(siblings)) and
+    opening/closing a node only updates its ancestors. Parents with a
+    `ChildList` cache one total per block instead, so changing one child
+    does not mean re-adding all of its siblings. Supports `len`, integer
+    and slice indexing, `index` and iteration like the list it replaces.
+    """
+
+    def __init__(self, tree, opened):
+        self.tree = tree
+        self.opened = opened
+        self.reset()
+
+    def reset(self):
+        """Drop all cached sizes (after changes that were not reported)"""
+        self.sizes = {}  # node.id -> visible rows in the subtree (opened nodes)
+        self.offsets = {}  # node.id -> (running totals, child ids, {id: position})
+        self.block_totals = {}  # id(block) -> (block, len(block), visible rows)
+
+    def forget(self, ids):
+        """Drop the cache entries of removed nodes"""
+        for id in ids:
+            self.sizes.pop(id, None)
+            self.offsets.pop(id, None)
+
+    def _skip(self, node):
+        return node.id not in self.opened or node.id in self.sizes
+
+    def size(self, node):
+        """Number of visible rows in the subtree of `node` (itself included)"""
+        if node.id not in self.opened:
+            return 1
+        size = self.sizes.get(node.id)
+        if size is not None:
+            return size
+        opened, sizes = self.opened, self.sizes
+        sorting, sort = bool(self.tree.sort_keys), self.tree._sort_children
+        for n, _ in self.tree.traverse(node.id, order="post", prune=self._skip):
+            if n.id in opened and n.id not in sizes:
+                if sorting and sort(n):  # shown for the first time since sorted
+                    self.offsets.pop(n.id, None)
+                total = 1
+                for c in n.data["children"]:
+                    total += sizes[c] if c in opened else 1
+                sizes[n.id] = total
+        return sizes[node.id]
+
+    def _offsets(self, node):
+        cached = self.offsets.get(node.id)
+        if cached is None:
+            children = node.data["children"]
+            registry = self.tree.registry
+            ids = list(children)
+            totals = list(accumulate((self.size(registry[c]) for c in ids), initial=0))
+            positions = {c: i for i, c in enumerate(ids)}
+            cached = self.offsets[node.id] = (totals, ids, positions)
+        return cached
+
+    def _block_total(self, block):
+        cached = self.block_totals.get(id(block))
+        if cached is not None and cached[0] is block and cached[1] == len(block):
+            return cached[2]
+        registry = self.tree.registry
+        total = sum(self.size(registry[c]) for c in block)
+        self.block_totals[id(block)] = (block, len(block), total)
+        return total
+
+    def _child_at(self, parent, i):
+        """
+        The child of opened `parent` at row `i` of its children's rows, as
+        `(child, row in the child's rows, position in parent's children)`
+        """
+        children = parent.data["children"]
+        registry = self.tree.registry
+        if not isinstance(children, ChildList):
+            totals, ids, _ = self._offsets(parent)
+            k = bisect_right(totals, i) - 1
+            return registry[ids[k]], i - totals[k], k
+        k = 0
+        for block in children.blocks:
+            total = self._block_total(block)
+            if i < total:
+                break
+            i -= total
+            k += len(block)
+        for c in block:
+            child = registry[c]
+            size = self.size(child)
+            if i < size:
+                return child, i, k
+            i -= size
+            k += 1
+
+    def _rows_before(self, parent, node):
+        """Rows of the siblings before `node`"""
+        children = parent.data["children"]
+        if not isinstance(children, ChildList):
+            totals, _, positions = self._offsets(parent)
+            return totals[positions[node.id]]
+        registry = self.tree.registry
+        block = children.block_of(node.id)
+        rows = 0
+        for b in children.blocks:
+            if b is block:
+                break
+            rows += self._block_total(b)
+        for c in block:
+            if c == node.id:
+                return rows
+            rows += self.size(registry[c])
+
+    def _propagate(self, node, delta):
+        """The size of `node` (which is attached) changed by `delta`"""
+        parent = self.tree.parent_of(node)
+        while parent is not None:
+            self.offsets.pop(parent.id, None)
+            children = parent.data["children"]
+            if isinstance(children, ChildList):
+                self.block_totals.pop(id(children.block_of(node.id)), None)
+            if parent.id not in self.opened or parent.id not in self.sizes:
+                break
+            self.sizes[parent.id] += delta
+            node, parent = parent, self.tree.parent_of(parent)
+
+    def attach(self, node):
+        """Account for `node` after it was attached to a parent"""
+        self.sizes.pop(node.id, None)  # its children may have changed too
+        self.offsets.pop(node.id, None)
+        self._propagate(node, self.size(node))
+
+    def detach(self, node):
+        """Account for `node` before it is disowned by its parent"""
+        self._propagate(node, -self.size(node))
+
+    def set_opened(self, node, value):
+        if (node.id in self.opened) == value:
+            return
+        old = self.size(node)
+        if value:
+            self.opened.add(node.id)
+        else:
+            self.opened.discard(node.id)
+        self.sizes.pop(node.id, None)
+        self.offsets.pop(node.id, None)
+        self._propagate(node, self.size(node) - old)
+
+    def set_subtree_opened(self, node, value, max_depth=None):
+        """
+        Open (or close) `node` and its descendants above `max_depth` levels
+        below it in one pass, then compute their sizes bottom-up. Closing
+        only visits opened nodes.
+        """
+        old = self.size(node)
+        root, registry, sizes, offsets = self.tree.root, self.tree.registry, self.sizes, self.offsets
+        opened = self.opened
+        sorting, sort = bool(self.tree.sort_keys), self.tree._sort_children
+        base = node.level
+        nodes = []  # pre-order, so reversed they come before their parents
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            if n.level - base == max_depth:
+                continue  # left as it was
+            nodes.append(n)
+            if value or n.id in opened:
+                stack.extend(map(registry.__getitem__, n.data["children"]))
+        for n in reversed(nodes):
+            children = n.data["children"]
+            offsets.pop(n.id, None)
+            if type(children) is ChildList:
+                for block in children.blocks:
+                    self.block_totals.pop(id(block), None)
+            # the root row always shows its children
+            if (value and children) or n is root:
+                opened.add(n.id)
+                if sorting:
+                    sort(n)
+            else:
+                opened.discard(n.id)
+                sizes.pop(n.id, None)
+                continue
+            if n.level - base + 1 == max_depth:  # children left as they were
+                sizes[n.id] = 1 + sum(self.size(registry[c]) for c in children)
+            else:
+                sizes[n.id] = 1 + sum([sizes.get(c, 1) for c in children])
+        self._propagate(node, self.size(node) - old)
+
+    def __len__(self):
+        return self.size(self.tree.root)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return [self._node_at(j) for j in range(start, stop, step)]
+            if stop <= start:
+                return []
+            return list(islice(self._iter_from(start), stop - start))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("visible row index out of range")
+        return self._node_at(i)
+
+    def _node_at(self, i, stack=None):
+        """
+        stack <list> (None): Appended with the siblings after the node and
+            after each of its ancestors, from the top, see `_iter_from`
+        """
+        node = self.tree.root
+        while i:
+            parent = node
+            node, i, k = self._child_at(parent, i - 1)  # - the row of `parent`
+            if stack is not None:
+                stack.append(islice(parent.data["children"], k + 1, None))
+        return node
+
+    def _iter_from(self, i):
+        """The rows from row `i` on, walked rather than looked up one by one"""
+        registry = self.tree.registry
+        stack = []
+        node = self._node_at(i, stack)
+        opened = self.opened
+        while True:
+            yield node
+            if node.id in opened and node.data["children"]:
+                stack.append(iter(node.data["children"]))
+            while stack:
+                c = next(stack[-1], None)
+                if c is not None:
+                    node = registry[c]
+                    break
+                stack.pop()
+            else:
+                return
+
+    def index(self, node):
+        """Visible row of `node`. ValueError if an ancestor is closed"""
+        i = 0
+        parent = self.tree.parent_of(node)
+        while parent is not None:
+            if parent.id not in self.opened:
+                raise ValueError(f"{node} is not visible")
+            i += 1 + self._rows_before(parent, node)
+            node, parent = parent, self.tree.parent_of(parent)
+        return i
+
+    def __iter__(self):
+        prune = lambda node: node.id not in self.opened
+        for node, _ in self.tree.traverse(prune=prune):
+            yield node
+
+
+class SearchIndex:
+    """
+    Trigram index over the label (or other data `fields`) of every node
+    of a tree, for substring and prefix search without visiting every
+    node. Each field is indexed as START + value.lower(), so a prefix
+    query is a substring query for START + query. The tree keeps its
+    indexes up to date (see `Tree._do_onchange` and `update`).
+    """
+
+    N = 3
+    START = "\x02"
+
+    def __init__(self, tree, fields=("label",)):
+        self.tree = tree
+        self.fields = fields
+        self.texts = {}  # node.id -> indexed text
+        self.grams = defaultdict(set)  # trigram -> node ids
+        texts, grams, n = self.texts, self.grams, self.N
+        for id, node in tree.registry.items():
+            if id != "root":
+                text = texts[id] = self._text(node)
+                for i in range(len(text) - n + 1):
+                    grams[text[i : i + n]].add(id)
+
+    def _text(self, node):
+        return "".join(
+            self.START + str(node.data[f]).lower()
+            for f in self.fields
+            if node.data.get(f) is not None
+        )
+
+    def _grams(self, text):
+        return {text[i : i + self.N] for i in range(len(text) - self.N + 1)}
+
+    def add(self, node):
+        if node.id == "root":
+            return
+        self.discard(node.id)
+        text = self.texts[node.id] = self._text(node)
+        for gram in self._grams(text):
+            self.grams[gram].add(node.id)
+
+    def discard(self, id):
+        text = self.texts.pop(id, None)
+        if text is None:
+            return
+        for gram in self._grams(text):
+            ids = self.grams[gram]
+            ids.discard(id)
+            if not ids:
+                del self.grams[gram]
+
+    def update(self, change):
+        """Apply a `Tree.last_change` summary"""
+        for id in change["removed"]:
+            self.discard(id)
+        registry = self.tree.registry
+        for id in change["added"] | change["updated"]:
+            if id in registry:
+                self.add(registry[id])
+
+    def search(self, query, prefix=False):
+        """Set of matching node ids"""
+        needle = query.lower()
+        if prefix:
+            needle = self.START + needle
+        if len(needle) < self.N:  # too short to index, scan the texts
+            return {id for id, text in self.texts.items() if needle in text}
+        postings = sorted(
+            (self.grams.get(gram, ()) for gram in self._grams(needle)), key=len
+        )
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return {id for id in candidates if needle in self.texts[id]}
+
+
+class FilteredRows:
+    """
+    The rows of a filtered `TreeWidget`: the nodes in `matches()` plus
+    their ancestors, in tree order. Ancestors are opened the first time
+    they are needed; closing one hides its part of the results. Offers
+    the same interface as `VisibleIndex`, recomputing after every change.
+    """
+
+    def __init__(self, tree, matches, opened):
+        self.tree = tree
+        self.matches = matches  # () -> set of node ids
+        self.opened = opened  # see `VisibleIndex`
+        self.needed = set()  # ancestors that were opened when first needed
+        self.expanded = set()  # ... by the filter and not toggled since
+        self.reset()
+
+    def reset(self):
+        self._rows = None
+
+    def forget(self, ids):
+        self.reset()  # called after every change
+
+    def attach(self, node):
+        self.reset()
+
+    def detach(self, node):
+        self.reset()
+
+    def set_opened(self, node, value):
+        if value:
+            self.opened.add(node.id)
+        else:
+            self.opened.discard(node.id)
+        self.expanded.discard(node.id)
+        self.reset()
+
+    def set_subtree_opened(self, node, value, max_depth=None):
+        opened = self.opened
+        prune = None if value else (lambda n: n.id not in opened)
+        for n, depth in self.tree.traverse(node.id, max_depth=max_depth, prune=prune):
+            if depth == max_depth:
+                continue
+            self.expanded.discard(n.id)
+            if (value and n.data["children"]) or n is self.tree.root:
+                opened.add(n.id)
+            else:
+                opened.discard(n.id)
+        self.reset()
+
+    def _ordered(self, parent, ids):
+        children = parent.data["children"]
+        if len(ids) * 8 < len(children):
+            return sorted(ids, key=children.index)
+        ids = set(ids)
+        return [c for c in children if c in ids]
+
+    @property
+    def rows(self):
+        if self._rows is not None:
+            return self._rows
+        registry = self.tree.registry
+        kids = defaultdict(list)  # parent.id -> shown children, unordered
+        shown = {"root"}
+        for id in self.matches():
+            node = registry[id]
+            while node.id not in shown:
+                shown.add(node.id)
+                kids[node.parent].append(node.id)
+                node = registry[node.parent]
+        for id in kids.keys() - self.needed:
+            self.needed.add(id)
+            if id not in self.opened:
+                self.opened.add(id)
+                self.expanded.add(id)
+
+        rows = []
+        stack = [self.tree.root]
+        while stack:
+            node = stack.pop()
+            rows.append(node)
+            if node.id in self.opened and node.id in kids:
+                self.tree._sort_children(node)
+                ids = self._ordered(node, kids[node.id])
+                stack.extend(registry[c] for c in reversed(ids))
+        self._rows = rows
+        return rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        return self.rows[i]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def index(self, node):
+        return self.rows.index(node)
+
+
+class Selection:
+    """
+    The selected rows of a `TreeWidget`. Clicked and shift-clicked rows
+    are kept as sorted, disjoint `[start, stop)` ranges of visible rows,
+    so selecting 50k rows stores two integers and no node is touched.
+    Rows move when the tree changes, so the ranges are first pinned to
+    the ids of the nodes they cover (see `pin`).
+    """
+
+    def __init__(self):
+        self.anchor = None  # id of the node shift-clicks extend from
+        self.clear()
+
+    def clear(self):
+        self.starts = []
+        self.stops = []
+        self.ids = {}  # pinned node ids (a dict, to keep their order)
+
+    def __bool__(self):
+        return bool(self.starts or self.ids)
+
+    def contains(self, row, id):
+        """Whether the node `id`, shown at `row`, is selected"""
+        if id in self.ids:
+            return True
+        k = bisect_right(self.starts, row) - 1
+        return k >= 0 and row < self.stops[k]
+
+    def add(self, start, stop):
+        """Select rows `start` to `stop` (excluded)"""
+        lo = bisect_left(self.stops, start)  # ranges overlapping or adjacent
+        hi = bisect_right(self.starts, stop)
+        if lo < hi:
+            start = min(start, self.starts[lo])
+            stop = max(stop, self.stops[hi - 1])
+        self.starts[lo:hi] = [start]
+        self.stops[lo:hi] = [stop]
+
+    def discard(self, row, id):
+        """Unselect the node `id`, shown at `row`"""
+        self.ids.pop(id, None)
+        k = bisect_right(self.starts, row) - 1
+        if k >= 0 and row < self.stops[k]:
+            start, stop = self.starts[k], self.stops[k]
+            pieces = [(a, b) for a, b in [(start, row), (row + 1, stop)] if a < b]
+            self.starts[k : k + 1] = [a for a, _ in pieces]
+            self.stops[k : k + 1] = [b for _, b in pieces]
+
+    def pin(self, rows):
+        """
+        Replace the ranges by the ids of the nodes they cover in `rows`
+        (a `VisibleIndex` or `FilteredRows`). Returns the selected ids.
+        """
+        for start, stop in zip(self.starts, self.stops):
+            self.ids.update(dict.fromkeys(node.id for node in rows[start:stop]))
+        self.starts, self.stops = [], []
+        return self.ids
 
 
 class TreeWidget(ipyw.VBox):
@@ -387,7 +2651,19 @@ class TreeWidget(ipyw.VBox):
         self,
         tree,
         height: int = 25,
+        renderer: str = "widgets",
+        frame_interval: float = 1 / 30,
     ):
+        """
+        height <int> (25): Number of rows in the window
+        renderer <str> ("widgets"): "widgets" renders every row as a
+            `NodeWidget` (a few ipywidgets each). "html" draws the whole
+            window as a single `HTMLRows` model, which is much cheaper for
+            tall windows but cannot host custom row widgets.
+        frame_interval <float> (1/30): Minimum seconds between two renders
+            caused by scrolling. Wheel and slider events arriving in
+            between are accumulated and rendered together.
+        """
         super().__init__()
         d = Event(
             source=self, watched_events=["wheel", "keydown"]
@@ -395,15 +2671,23 @@ class TreeWidget(ipyw.VBox):
         d.on_dom_event(self.event_handler)
         self.add_class("better-tree-box")
         self.tree = tree
-        self.tree.onchange(self.refresh)
-        self.tree.widget = self
-        self.rows = [
-            NodeWidget(
-                self._open_callback,
-                self._select_callback,
-            )
-            for i in range(height)
-        ]
+        self._onchange = lambda: self.refresh()  # looked up, see `instrument`
+        self.tree.onchange(self._onchange)
+        self.tree.views.append(self)
+        self.renderer = renderer
+        if renderer == "html":
+            self.rows = []
+            self.html_rows = HTMLRows(self._open_callback, self._select_callback)
+        elif renderer == "widgets":
+            self.rows = [
+                NodeWidget(
+                    self._open_callback,
+                    self._select_callback,
+                )
+                for i in range(height)
+            ]
+        else:
+            raise ValueError(f"unknown renderer: {renderer}")
 
         for nw in self.rows:
             nw.add_class("better-tree-node-row")
@@ -418,17 +2702,30 @@ class TreeWidget(ipyw.VBox):
 
         self.height = height
         self.cursor = 0
+        self.refresh_messages = 0  # widget models synced by the last refresh
+        self.messages_sent = 0  # ... and by all refreshes
         self.selected_node = None
-
-        self.scroll_speed = 1  # set and incrimented in self.scroll
-        self.last_deltaY = 0  # attr for deltaY to prevent trackpad accel
-        self.trackpad_collector = 0
-        self.last_scroll_time = time.time()
+        self.selection = Selection()
+        self.opened = {"root"}  # ids of the nodes opened in this view
+        self.visible_index = VisibleIndex(tree, self.opened)
+        self.viewable_nodes = self.visible_index  # or `FilteredRows`
+
+        # Scrolling, see `_wheel` and `_request_frame`
+        self.frame_interval = frame_interval
+        self.momentum = 0.05  # extra rows per row/second of wheel velocity
+        self.momentum_time = 0.2  # seconds for the velocity to decay
+        self.velocity = 0.0  # rows/second, smoothed
+        self._pending_rows = 0.0  # wheel input not yet rendered
+        self._last_wheel = time.perf_counter()
+        self._last_frame = 0.0
+        self._frame_handle = None
+        self._frame_dirty = False
+        self._moving_slider = False
+        self._stats = None  # see `instrument`
 
         self.node_window = ipyw.VBox()
         self.node_window.add_class("better-tree-node-window")
 
-        self._collapse_all()
         self.compute_visible()
         self.refresh()
 
@@ -438,52 +2735,285 @@ class TreeWidget(ipyw.VBox):
 
         self.children = [full_window, CSS]
 
-    def _collapse_all(self):
-        for id, node in self.tree.registry.items():
-            node.opened = False
-            node.selected = False
-        self.tree.root.opened = True
+    PHASES = {
+        "refresh": ("messages", lambda widget, _: widget.refresh_messages),
+        "_compute_inview": ("rows", lambda widget, rows: len(rows)),
+        "compute_visible": ("rows", lambda widget, _: len(widget.viewable_nodes)),
+        "_set_opened": (None, None),
+        "_frame": (None, None),
+        "goto_node": (None, None),
+        "filter": ("rows", lambda widget, _: len(widget.viewable_nodes)),
+    }
+
+    def instrument(self, enabled: bool = True, hook: Callable = None):
+        """
+        Like `Tree.instrument`, for the phases of the widget. "messages" of
+        `refresh` are the widget models synced with the frontend (one per
+        batch of trait writes), "rows" are rows computed or rendered.
+        """
+        self._stats = _instrument(self, self._stats, self.PHASES, enabled, hook)
+
+    def stats(self):
+        """See `Tree.stats`"""
+        return self._stats.summary() if self._stats else {}
+
+    def close(self):
+        """Stop showing the tree (its other views are unaffected)"""
+        tree = getattr(self, "tree", None)
+        if tree is not None and self in tree.views:
+            tree.views.remove(self)
+            tree.onchange_todos.remove(self._onchange)
+        super().close()
 
     @observe("selected_id", type="change")
     def _update_selected_node(self, event):
         if event["new"]:
             self.selected_node = self.tree.registry[self.selected_id]
 
-    def _compute_visible(self, id="root"):
-        collector = []
-        node = self.tree.registry[id]
-        collector.append(node)
-        if node.opened:
-            for c in node.data["children"]:
-                collector += self._compute_visible(c)
-        return collector
-
     def compute_visible(self):
-        self.viewable_nodes = self._compute_visible()
+        self.viewable_nodes.reset()
+        self._update_slider()
+
+    def filter(
+        self,
+        query: str = None,
+        predicate: Callable[[Node], bool] = None,
+        prefix: bool = False,
+        fields=("label",),
+    ):
+        """
+        Only show the nodes matching `query` (see `Tree.search`) and/or
+        `predicate`, together with their ancestors, which are opened.
+        Call without arguments to show the whole tree again: the ancestors
+        opened by the filter (and not toggled since) are closed again.
+        """
+        self._pin_selection()
+        if self.viewable_nodes is not self.visible_index:
+            self.opened.difference_update(self.viewable_nodes.expanded)
+            self.visible_index.reset()
+        if query is None and predicate is None:
+            self.viewable_nodes = self.visible_index
+        else:
+
+            def matches():
+                if query is not None:
+                    ids = self.tree.search(query, prefix, fields)
+                    if predicate is None:
+                        return ids
+                    return {i for i in ids if predicate(self.tree.registry[i])}
+                return {n.id for n in self.tree.dfs() if predicate(n)} - {"root"}
+
+            self.viewable_nodes = FilteredRows(self.tree, matches, self.opened)
+        self.compute_visible()
+        self._move_slider(len(self.viewable_nodes))  # back to the top
+        self.refresh()
+
+    def _hide(self, node):
+        """Take the rows of `node` out of `viewable_nodes`"""
+        if node is not self.tree.root:  # root is rebuilt by `_show`
+            self.viewable_nodes.detach(node)
+
+    def _show(self, node):
+        """Add the rows of `node` (already attached) to `viewable_nodes`"""
+        if node is self.tree.root:
+            return self.compute_visible()
+        self.viewable_nodes.attach(node)
+
+    def _update_slider(self):
         if len(self.viewable_nodes) > 1:
             previous_max = self.slider.max
             previous_value = self.slider.value
             new_value = len(self.viewable_nodes) - (previous_max - previous_value)
-            self.slider.max = len(self.viewable_nodes)
-            self.slider.value = new_value
+            self._move_slider(new_value, maximum=len(self.viewable_nodes))
+
+    def _move_slider(self, value, maximum=None):
+        """
+        Set the slider (and the cursor to match) without going through
+        `_slider_onchange`. The caller is responsible for refreshing.
+        """
+        self._moving_slider = True
+        try:
+            if maximum is not None:
+                self.slider.max = maximum
+            self.slider.value = value
+        finally:
+            self._moving_slider = False
+        self.cursor = max(0, len(self.viewable_nodes) - self.slider.value)
 
     def _compute_inview(self):
         return self.viewable_nodes[self.cursor : self.cursor + self.height]
 
     def _open_callback(self, id, value):
-        self.tree.registry[id].opened = value
-        self.compute_visible()
+        node = self.tree.registry[id]
+        self._pin_selection()
+        self._set_opened(node, value)
+        self._update_slider()
         self.refresh()
+        self.tree._publish_events()
+        if value and isinstance(node, LazyNode) and not node.loaded:
+            # Shown (and sent to the frontend) while the loader runs
+            with self.tree.journal.pause():
+                placeholder = self.tree.insert(
+                    {"label": "loading\u2026", "type": "loading"}, node.id
+                )
+                try:
+                    self.tree.load_children(node)
+                finally:
+                    self.tree.remove(placeholder)
 
-    def _select_callback(self, id):
-        if (
-            self.selected_id in self.tree.registry
-        ):  # may have been deleted since selection
-            self.tree.registry[self.selected_id].selected = False
-        self.tree.registry[id].selected = True
+    def _select_callback(self, id, extend=False, toggle=False):
+        """
+        A click on the node `id` selects only it. With `toggle` (ctrl-click)
+        it is added to or removed from the selection instead, and with
+        `extend` (shift-click) every row from the last clicked node to it
+        is selected too.
+        """
+        registry, rows, selection = self.tree.registry, self.viewable_nodes, self.selection
+        row = rows.index(registry[id])
+        anchor = registry.get(selection.anchor)
+        if extend and anchor is not None:
+            try:
+                start = rows.index(anchor)
+            except ValueError:  # hidden since
+                start = row
+            if not toggle:
+                selection.clear()
+            selection.add(min(start, row), max(start, row) + 1)
+        elif toggle:
+            if selection.contains(row, id):
+                selection.discard(row, id)
+            else:
+                selection.add(row, row + 1)
+            selection.anchor = id
+        else:
+            selection.clear()
+            selection.add(row, row + 1)
+            selection.anchor = id
         self.selected_id = id
         self.refresh()
 
+    def expand_subtree(self, node: Union[str, Node], depth: int = None):
+        """
+        Open `node` and its descendants down to `depth` levels below it
+        (all of them if None), refreshing once. `LazyNode`s that were
+        never opened stay closed.
+        """
+        self._set_subtree_opened(node, True, depth)
+
+    def collapse_subtree(self, node: Union[str, Node]):
+        """Close `node` and every opened node beneath it"""
+        self._set_subtree_opened(node, False)
+
+    def expand_to_level(self, level: int):
+        """Show every node down to `level` (1 for the top level) and no deeper"""
+        self._pin_selection()
+        self._set_opened(self.tree.root, False, None)
+        self._set_subtree_opened(self.tree.root, True, level)
+
+    def _set_subtree_opened(self, node, value, depth=None):
+        self._pin_selection()
+        self._set_opened(self.tree._handle_type(node), value, depth)
+        self._update_slider()
+        self.refresh()
+        self.tree._publish_events()
+
+    def _set_opened(self, node, value, depth=1):
+        """Open or close `node` and, unless `depth` is 1, its descendants"""
+        if depth == 1:
+            if (node.id in self.opened) == value:
+                return
+            self.viewable_nodes.set_opened(node, value)
+        else:
+            self.viewable_nodes.set_subtree_opened(node, value, depth)
+        self.tree._emit(OpenChanged, node.id, value, depth, self)
+
+    def _pin_selection(self):
+        """Call before the rows change, see `Selection.pin`"""
+        self.selection.pin(self.viewable_nodes)
+
+    def selected_ids(self):
+        """Ids of the selected nodes"""
+        ids = self.selection.pin(self.viewable_nodes)
+        return [id for id in ids if id in self.tree.registry]
+
+    def _selection_roots(self):
+        """
+        The selected nodes without a selected ancestor, in tree order. The
+        root cannot be moved or removed: when selected, its selected
+        children stand for it.
+        """
+        registry = self.tree.registry
+        ids = set(self.selected_ids())
+        ids.discard("root")
+        roots = []
+        for id in ids:
+            parent = registry[id].parent
+            while parent is not None and parent not in ids:
+                parent = registry[parent].parent
+            if parent is None:
+                roots.append(registry[id])
+
+        positions = {}  # parent id -> {child id: position}
+
+        def path(node):
+            key = []
+            while node.parent is not None:
+                index = positions.get(node.parent)
+                if index is None:
+                    children = registry[node.parent].data["children"]
+                    index = positions[node.parent] = {c: i for i, c in enumerate(children)}
+                key.append(index[node.id])
+                node = registry[node.parent]
+            return key[::-1]
+
+        return sorted(roots, key=path)
+
+    def move_selected(self, parent: Union[str, Node], position: int = None):
+        """
+        Move the selected nodes (with their subtrees) beneath `parent`, in
+        tree order, starting at `position`. One transaction, one refresh.
+        """
+        parent = self.tree._handle_type(parent)
+        roots = self._selection_roots()
+        moved = {node.id for node in roots}
+        ancestor = parent
+        while ancestor is not None:
+            if ancestor.id in moved:
+                raise ValueError("cannot move the selection beneath itself")
+            ancestor = self.tree.parent_of(ancestor)
+        with self.tree.batch():
+            for i, node in enumerate(roots):
+                self.tree.move(node, parent, None if position is None else position + i)
+
+    def remove_selected(self):
+        """Remove the selected nodes and their subtrees. One transaction"""
+        roots = self._selection_roots()
+        self.selection.clear()
+        self.selected_node = self.selected_id = None
+        with self.tree.batch():
+            for node in roots:
+                self.tree.remove(node)
+
+    def open_selected(self, value: bool = True):
+        """
+        Open (or close) every selected node but the root, with a single
+        refresh
+        """
+        registry = self.tree.registry
+        nodes = [registry[id] for id in self.selected_ids() if id != "root"]
+        for node in nodes:
+            if node.expandable:
+                self._set_opened(node, value)
+        lazy = [n for n in nodes if isinstance(n, LazyNode) and not n.loaded]
+        if value and lazy:
+            with self.tree.batch():  # refreshes once when done
+                for node in lazy:
+                    self.tree.load_children(node)
+            return
+        self._update_slider()
+        self.refresh()
+        self.tree._publish_events()
+
     def _add_node_callback(self, **kwargs):
         self.tree.add_node(**kwargs)
         self.refresh()
@@ -492,13 +3022,64 @@ class TreeWidget(ipyw.VBox):
         self.cursor += val
         self.cursor = min(self.cursor, len(self.viewable_nodes) - 1)
         self.cursor = max(self.cursor, 0)
-        self.slider.value = len(self.viewable_nodes) - self.cursor
-        # self.refresh()
-        # Forces onchange event `_slider_onchange`
+        self._move_slider(len(self.viewable_nodes) - self.cursor)
+        self.refresh()
 
     def _slider_onchange(self, event):
-        if "new" in event:
-            self.goto_index(len(self.viewable_nodes) - event["new"])
+        if "new" in event and not self._moving_slider:
+            self.cursor = len(self.viewable_nodes) - event["new"]
+            self._frame_dirty = True
+            self._request_frame()
+
+    def _wheel(self, event):
+        """
+        Convert a wheel event to rows and add it to the pending scroll.
+        The faster the wheel moves, the further each event scrolls.
+        """
+        rows = event["deltaY"]
+        mode = event.get("deltaMode", 0)
+        if mode == 0:  # pixels
+            rows /= ROW_HEIGHT
+        elif mode == 2:  # pages
+            rows *= self.height
+        now = time.perf_counter()
+        dt = max(now - self._last_wheel, 1e-3)
+        self._last_wheel = now
+        decay = math.exp(-dt / self.momentum_time)
+        self.velocity = self.velocity * decay + (rows / dt) * (1 - decay)
+        self._pending_rows += rows * (1 + abs(self.velocity) * self.momentum)
+        self._request_frame()
+
+    def _request_frame(self):
+        """
+        Render now if the last frame is at least `frame_interval` old,
+        otherwise schedule a single render for when it is.
+        """
+        if self._frame_handle is not None:
+            return  # already scheduled
+        delay = self._last_frame + self.frame_interval - time.perf_counter()
+        if delay > 0:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:  # not running in a kernel, render now
+                pass
+            else:
+                self._frame_handle = loop.call_later(delay, self._frame)
+                return
+        self._frame()
+
+    def _frame(self):
+        self._frame_handle = None
+        self._last_frame = time.perf_counter()
+        rows = int(self._pending_rows)  # keep the fraction for next time
+        self._pending_rows -= rows
+        if rows:
+            cursor = min(max(self.cursor + rows, 0), len(self.viewable_nodes) - 1)
+            self._move_slider(len(self.viewable_nodes) - cursor)
+            self._frame_dirty = True
+        if self._frame_dirty:
+            self._frame_dirty = False
+            self.refresh()
 
     def goto_index(self, index):
         self.cursor = index
@@ -506,32 +3087,26 @@ class TreeWidget(ipyw.VBox):
 
     def goto_node(self, node_id):
         node = self.tree.registry[node_id]
+        self._pin_selection()
         parent = self.tree.parent_of(node)
         while parent.id != "root":
-            parent.opened = True
+            self._set_opened(parent, True)
             parent = self.tree.parent_of(parent)
-        self.compute_visible()
-        self.refresh()
+        self._update_slider()
 
-        for i, n in enumerate(self.viewable_nodes):
-            if n.id == node.id:
-                self.cursor = i
-                break
-        self.slider.value = len(self.viewable_nodes) - self.cursor
+        self._move_slider(len(self.viewable_nodes) - self.viewable_nodes.index(node))
         self.refresh()
+        self.tree._publish_events()
 
     def event_handler(self, event):
-        # TODO: add trackpad detection/option
-        if "deltaY" in event:  # Mousewheel
-            direction = 1 if event["deltaY"] > 0 else -1
-            if time.time() - self.last_scroll_time < 0.1:  # Accelerate
-                self.last_deltaY = event["deltaY"]
-                self.scroll_speed += 2
-                self.last_scroll_time = time.time()
-                self.scroll(self.scroll_speed * direction)
-            else:  # Reset Speed to 1
-                self.scroll_speed = 1
-                self.scroll(direction)
+        undo_key = event.get("key") in ("z", "Z", "y", "Y")
+        if "deltaY" in event:  # Mousewheel or trackpad
+            self._wheel(event)
+        elif undo_key and (event.get("ctrlKey") or event.get("metaKey")):
+            if event["key"] in ("y", "Y") or event.get("shiftKey"):
+                self.tree.redo()
+            else:
+                self.tree.undo()
         elif self.selected_node is not None:  # Key Event
             k = event.get("key", None)
             ctrl = event.get("ctrlKey", False)
@@ -569,9 +3144,30 @@ class TreeWidget(ipyw.VBox):
 
     def refresh(self):
         inview = self._compute_inview()
+        selected = [
+            self.selection.contains(self.cursor + i, node.id)
+            for i, node in enumerate(inview)
+        ]
+        opened = [node.id in self.opened for node in inview]
+        if self.renderer == "html":
+            messages = self.html_rows.load(inview, selected, opened)
+            if self.node_window.children != (self.html_rows,):
+                self.node_window.children = [self.html_rows]
+                messages += 1
+            self.refresh_messages = messages
+            self.messages_sent += messages
+            return
+
+        # One message per row model that changed: models sync separately
+        messages = 0
         for i, node in enumerate(inview):
-            self.rows[i].load(node)
-        self.node_window.children = self.rows[: len(inview)]
+            messages += self.rows[i].load(node, selected[i], opened[i])
+        rows = tuple(self.rows[: len(inview)])
+        if self.node_window.children != rows:
+            self.node_window.children = rows
+            messages += 1
+        self.refresh_messages = messages
+        self.messages_sent += messages
 
 
 class NodeWidget(ipyw.HBox):
@@ -593,6 +3189,7 @@ class NodeWidget(ipyw.HBox):
 
         # State Variables
         self.opened = False
+        self._rendered = (None,) * 5  # see `load`
 
         # Widgets
         self.button = ipyw.Button()
@@ -607,8 +3204,8 @@ class NodeWidget(ipyw.HBox):
         self.button.add_class("better-tree-btn")
 
         # Events
-        # Button Clicks
-        self.button.on_click(self.select)
+        # Button Clicks (through ipyevents, for the modifier keys)
+        Event(source=self.button, watched_events=["click"]).on_dom_event(self.select)
         self.expand_btn.on_click(self.expand)
 
         # Traitlets
@@ -618,29 +3215,124 @@ class NodeWidget(ipyw.HBox):
 
     def expand(self, _=None):
         self.opened = not self.opened
-        self.expand_btn.icon = "angle-down" if self.opened else "angle-right"
-        self._open_callback(self.id, self.opened)
-
-    def select(self, _=None):
-        # self.button.add_class("better-tree-selected")
-        self._select_callback(self.id)
-
-    def load(self, node):
-        self.button.icon = ICONS.get(node.data["type"], "align-justify")
-        self.button.description = node.data.get("label", "")
-        self.indent_box.value = "&nbsp" * node.level * 3
-        self.opened = node.opened
-        if node.data["children"]:
-            if node.opened:
-                self.expand_btn.icon = "chevron-down"
-            else:
-                self.expand_btn.icon = "chevron-right"
+        self._open_callback(self.id, self.opened)  # re-renders this row
+
+    def select(self, event=None):
+        event = event or {}
+        self._select_callback(
+            self.id,
+            extend=event.get("shiftKey", False),
+            toggle=event.get("ctrlKey", False) or event.get("metaKey", False),
+        )
+
+    def load(self, node, selected=False, opened=False):
+        """
+        Render `node` in this row, assigning only what differs from the
+        last rendered state. Returns the number of widget models that had
+        to be synced with the frontend.
+        """
+        self.id = node.id
+        self.opened = opened
+        if node.expandable:
+            expand_icon = "chevron-down" if opened else "chevron-right"
         else:
-            self.expand_btn.icon = "none"
+            expand_icon = "none"
+        state = (
+            ICONS.get(node.data.get("type"), "align-justify"),
+            node.data.get("label", ""),
+            selected,
+            node.level,
+            expand_icon,
+        )
+        last = self._rendered
+        if state == last:
+            return 0
+        self._rendered = state
+        messages = 0
+
+        if state[:3] != last[:3]:
+            icon, description, selected = state[:3]
+            with self.button.hold_sync():
+                self.button.icon = icon
+                self.button.description = description
+                if selected:
+                    self.button.add_class("better-tree-selected")
+                else:
+                    self.button.remove_class("better-tree-selected")
+            messages += 1
+        if state[3] != last[3]:
+            self.indent_box.value = "&nbsp" * node.level * 3
+            messages += 1
+        if state[4] != last[4]:
+            self.expand_btn.icon = expand_icon
+            messages += 1
+        return messages
+
+
+class HTMLRows(ipyw.HTML):
+    """
+    Every row of the window drawn into one HTML model, so a refresh is a
+    single `value` message regardless of the number of rows. Clicks are
+    delegated through one `ipyevents.Event` and mapped back to a row by
+    position (see `ROW_HEIGHT`, `INDENT` and `TOGGLE_WIDTH`).
+    """
 
-        if node.selected:
-            self.button.add_class("better-tree-selected")
+    def __init__(
+        self,
+        _open_callback,
+        _select_callback,
+    ):
+        super().__init__()
+        self._open_callback = _open_callback
+        self._select_callback = _select_callback
+        self.nodes = []  # the nodes currently drawn, top to bottom
+        self.opened = []  # ... and whether each of them is opened
+        d = Event(source=self, watched_events=["click"])
+        d.on_dom_event(self._click)
+
+    @staticmethod
+    def _row(node, selected=False, opened=False):
+        if node.expandable:
+            toggle = "chevron-down" if opened else "chevron-right"
+            toggle = f'<i class="fa fa-{toggle}"></i>'
         else:
-            self.button.remove_class("better-tree-selected")
+            toggle = ""
+        icon = ICONS.get(node.data.get("type"), "align-justify")
+        selected = " better-tree-selected" if selected else ""
+        return (
+            f'<div class="better-tree-html-row{selected}">'
+            f'<span style="width: {node.level * INDENT}px"></span>'
+            f'<span class="better-tree-toggle">{toggle}</span>'
+            f'<i class="fa fa-{icon}"></i> '
+            f'{escape(str(node.data.get("label", "")))}</div>'
+        )
 
-        self.id = node.id
+    def load(self, nodes, selected=None, opened=None):
+        """
+        Draw `nodes`, highlighting those flagged in `selected` and with the
+        toggles of those flagged in `opened` open. Returns the number of
+        widget models synced (0 or 1)
+        """
+        self.nodes = nodes
+        selected = selected or [False] * len(nodes)
+        self.opened = opened = opened or [False] * len(nodes)
+        value = "".join([self._row(*row) for row in zip(nodes, selected, opened)])
+        if value == self.value:
+            return 0
+        self.value = value
+        return 1
+
+    def _click(self, event):
+        row = int(event.get("relativeY", -1) // ROW_HEIGHT)
+        if not 0 <= row < len(self.nodes):
+            return
+        node = self.nodes[row]
+        x = event.get("relativeX", 0) - node.level * INDENT
+        if 0 <= x < TOGGLE_WIDTH and node.expandable:
+            self._open_callback(node.id, not self.opened[row])
+        else:
+            self._select_callback(
+                node.id,
+                extend=event.get("shiftKey", False),
+                toggle=event.get("ctrlKey", False) or event.get("metaKey", False),
+            )
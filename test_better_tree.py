@@ -0,0 +1,905 @@
+import asyncio
+import os
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+import better_tree as bt
+
+
+def check(tree, widget=None):
+    """The registry is consistent and the rows are a pre-order walk"""
+    tree._validate()
+    levels = {id: node.level for id, node in tree.registry.items()}
+    tree._compute_depth()
+    assert levels == {id: node.level for id, node in tree.registry.items()}
+    if widget is None:
+        return
+    expected = [n for n, _ in tree.traverse(prune=lambda n: n.id not in widget.opened)]
+    index = bt.VisibleIndex(tree, widget.opened)
+    for rows in (widget.visible_index, index):
+        assert list(rows) == expected
+        assert len(rows) == len(expected)
+        assert [rows[i] for i in range(len(rows))] == expected
+        assert [rows.index(n) for n in expected] == list(range(len(expected)))
+
+
+def ids(tree, node_id="root"):
+    return list(tree.registry[node_id].data["children"])
+
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    """Switch to `ChildList`s from a few children on"""
+    monkeypatch.setattr(bt.ChildList, "BLOCK", 2)
+    monkeypatch.setattr(bt.ChildList, "THRESHOLD", 3)
+
+
+@pytest.fixture
+def tree():
+    """root: a (a0 a1 a2 (a2x)), b (b0 b1), c"""
+    tree = bt.Tree()
+    tree.insert_nested_dicts(
+        [
+            {
+                "id": "a",
+                "label": "a",
+                "children": [
+                    {"id": "a0", "label": "a0"},
+                    {"id": "a1", "label": "a1"},
+                    {"id": "a2", "label": "a2", "children": [{"id": "a2x", "label": "a2x"}]},
+                ],
+            },
+            {
+                "id": "b",
+                "label": "b",
+                "children": [{"id": "b0", "label": "b0"}, {"id": "b1", "label": "b1"}],
+            },
+            {"id": "c", "label": "c"},
+        ]
+    )
+    tree.journal.clear()
+    return tree
+
+
+@pytest.mark.parametrize("blocks", [False, True])
+def test_remove_flat_splices_children_in_place(tree, blocks, request):
+    if blocks:
+        request.getfixturevalue("small_blocks")
+        tree.move("c", "root", 0)  # the root's children become a ChildList
+    w = bt.TreeWidget(tree)
+    w._open_callback("a", True)
+    before = ids(tree)
+    tree.remove("a", recursive=False)
+    position = before.index("a")
+    assert ids(tree) == before[:position] + ["a0", "a1", "a2"] + before[position + 1 :]
+    assert "a" not in tree.registry
+    assert all(tree.registry[id].parent == "root" for id in ("a0", "a1", "a2"))
+    assert tree.registry["a2x"].level == 2
+    check(tree, w)
+
+    tree.undo()
+    assert ids(tree) == before
+    assert ids(tree, "a") == ["a0", "a1", "a2"]
+    check(tree, w)
+    tree.redo()
+    assert ids(tree) == before[:position] + ["a0", "a1", "a2"] + before[position + 1 :]
+    check(tree, w)
+
+
+def test_remove_children(tree):
+    w = bt.TreeWidget(tree)
+    w._open_callback("a", True)
+    w._open_callback("a2", True)
+    tree.remove_children("a")
+    assert ids(tree, "a") == []
+    assert not {"a0", "a1", "a2", "a2x"} & tree.registry.keys()
+    assert tree.last_change["removed"] == {"a0", "a1", "a2", "a2x"}
+    check(tree, w)
+
+    tree.undo()
+    assert ids(tree, "a") == ["a0", "a1", "a2"]
+    assert ids(tree, "a2") == ["a2x"]
+    check(tree, w)
+
+    tree.remove_children("root")
+    assert set(tree.registry) == {"root"}
+    check(tree, w)
+
+
+def test_free(tree):
+    w = bt.TreeWidget(tree)
+    freed = tree._free(tree.registry["a"])
+    assert [n.id for n in freed] == ["a", "a0", "a1", "a2", "a2x"]
+    assert not {n.id for n in freed} & tree.registry.keys()
+    tree._disown(freed[0])  # what `remove` does next
+    w.compute_visible()
+    check(tree, w)
+
+
+def test_random_edits(small_blocks):
+    rng = random.Random(0)
+    tree = bt.Tree()
+    tree.insert_nested_dicts(
+        [{"label": str(i), "children": [{"label": f"{i}.{j}"} for j in range(3)]} for i in range(5)]
+    )
+    w = bt.TreeWidget(tree)
+    for _ in range(300):
+        nodes = [id for id in tree.registry if id != "root"]
+        op = rng.choice(["move", "move", "insert", "remove", "flat", "children", "open"])
+        if op == "insert" or not nodes:
+            tree.insert({"label": "x"}, rng.choice(list(tree.registry)))
+        elif op == "move":
+            node = rng.choice(nodes)
+            subtree = {n.id for n in tree.dfs(node)}
+            parent = rng.choice([id for id in tree.registry if id not in subtree])
+            tree.move(node, parent, rng.choice([None, 0, len(ids(tree, parent)) // 2]))
+        elif op == "remove":
+            tree.remove(rng.choice(nodes))
+        elif op == "flat":
+            tree.remove(rng.choice(nodes), recursive=False)
+        elif op == "children":
+            tree.remove_children(rng.choice(nodes))
+        else:
+            node = rng.choice(nodes)
+            w._open_callback(node, node not in w.opened)
+        check(tree, w)
+
+
+def test_bulk_insert_is_one_step(tree, small_blocks):
+    nodes = tree.bulk_insert([{"label": str(i)} for i in range(20)], "c")
+    assert len(tree.journal.undo_steps[-1][1]) == 1
+    children = tree.registry["c"].data["children"]
+    w = bt.TreeWidget(tree)
+    w._open_callback("c", True)
+    w.scroll(8)  # root a b c, then the new children
+    assert [n.id for n in w._compute_inview()][:2] == [nodes[4].id, nodes[5].id]
+    assert children._block_of is None  # not needed to append or show them
+    tree.remove(nodes[3])
+    check(tree, w)
+    tree.undo()
+    tree.undo()
+    assert ids(tree, "c") == []
+    check(tree, w)
+    tree.redo()
+    assert ids(tree, "c") == [n.id for n in nodes]
+    check(tree, w)
+
+
+def test_failing_loader_can_be_retried(tree):
+    calls = []
+
+    def loader(node):
+        calls.append(node.id)
+        if len(calls) == 1:
+            raise OSError("unavailable")
+        return [{"id": "child", "label": "child"}]
+
+    tree.add_node(bt.LazyNode({"id": "lazy", "label": "lazy"}, loader))
+    w = bt.TreeWidget(tree)
+    with pytest.raises(OSError):
+        w._open_callback("lazy", True)
+    assert not tree.registry["lazy"].loaded
+    assert ids(tree, "lazy") == []
+    w._open_callback("lazy", False)
+    w._open_callback("lazy", True)
+    assert ids(tree, "lazy") == ["child"]
+    check(tree, w)
+
+
+def make_files(root, paths):
+    for path in paths:
+        path = Path(root, path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+
+
+def files(tree):
+    return {id for id, n in tree.registry.items() if n.data.get("type") not in ("folder", None)}
+
+
+@pytest.mark.parametrize("pattern", ["*.txt", "a1/*", "x/a1/*.py", "a1/*.txt"])
+def test_rglob_matches_like_path_rglob(tmp_path, pattern):
+    make_files(tmp_path, [f"{d}/{f}" for d in ("a1", "x/a1", "b") for f in ("f.txt", "g.py")])
+    expected = {str(p) for p in tmp_path.rglob(pattern) if p.is_file()}
+    tree = bt.Tree()
+    tree.rglob(tmp_path, pattern)
+    assert files(tree) == expected
+    check(tree)
+    asynchronous = bt.Tree()
+    asyncio.run(asynchronous.rglob_async(tmp_path, pattern))
+    assert set(asynchronous.registry) == set(tree.registry)
+    with pytest.raises(ValueError):
+        bt.Tree().rglob(tmp_path, "**/" + pattern)
+
+
+def test_child_list_behaves_like_a_list(small_blocks):
+    rng = random.Random(1)
+    plain, blocks = [], bt.ChildList()
+    for i in range(500):
+        op = rng.random()
+        if op < 0.5 or not plain:
+            position = rng.randrange(len(plain) + 1)
+            plain.insert(position, str(i))
+            blocks.insert(position, str(i))
+        elif op < 0.8:
+            id = rng.choice(plain)
+            plain.remove(id)
+            blocks.remove(id)
+        else:
+            id = rng.choice(plain)
+            assert blocks.index(id) == plain.index(id)
+        assert blocks == plain
+    assert list(reversed(blocks)) == plain[::-1]
+
+
+def test_filter_clear_closes_what_it_opened(tree):
+    w = bt.TreeWidget(tree)
+    w._open_callback("b", True)
+    before = set(w.opened)
+    w.filter("a2x")
+    assert [n.id for n in w.viewable_nodes] == ["root", "a", "a2", "a2x"]
+    w.filter()
+    assert w.opened == before
+    check(tree, w)
+    w.filter("a2x")
+    w._open_callback("a", False)
+    w._open_callback("a", True)  # toggled by the user: kept open
+    w.filter()
+    assert w.opened == before | {"a"}
+    check(tree, w)
+
+
+def test_undo_redo(tree):
+    w = bt.TreeWidget(tree)
+    snapshot = tree.to_list()
+    tree.move("b1", "a", 0)
+    tree.remove("a2")
+    tree.update("c", label="see")
+    tree.insert_nested_dicts([{"label": "n", "children": [{"label": "m"}]}], "b")
+    after = tree.to_list()
+    for _ in range(4):
+        tree.undo()
+    assert tree.to_list() == snapshot
+    check(tree, w)
+    for _ in range(4):
+        tree.redo()
+    assert tree.to_list() == after
+    check(tree, w)
+
+
+def test_insert_nested_dicts_is_one_step(tree):
+    tree.insert_nested_dicts([{"label": str(i), "children": [{"label": "x"}]} for i in range(50)])
+    tree.undo()
+    assert set(tree.registry) == {"root", "a", "a0", "a1", "a2", "a2x", "b", "b0", "b1", "c"}
+    check(tree)
+
+
+def test_views_have_their_own_open_nodes(tree):
+    first, second = bt.TreeWidget(tree), bt.TreeWidget(tree)
+    first._open_callback("a", True)
+    assert "a" in first.opened and "a" not in second.opened
+    assert len(first.viewable_nodes) == len(second.viewable_nodes) + 3
+    tree.insert({"id": "a3", "label": "a3"}, "a")
+    check(tree, first)
+    check(tree, second)
+    second.close()
+    assert tree.views == [first]
+    tree.remove("a")
+    check(tree, first)
+
+
+def test_sort_by(tree):
+    w = bt.TreeWidget(tree)
+    w._open_callback("a", True)
+    tree.sort_by("label", reverse=True)
+    assert ids(tree) == ["c", "b", "a"]
+    assert ids(tree, "a") == ["a2", "a1", "a0"]
+    tree.insert({"id": "bb", "label": "bb"})
+    tree.move("a1", "root", 0)  # the position is ignored
+    assert ids(tree) == ["c", "bb", "b", "a1", "a"]
+    tree.update("c", label="0")
+    assert ids(tree) == ["bb", "b", "a1", "a", "c"]
+    assert ids(tree, "b") == ["b0", "b1"]  # reordered once shown
+    w._open_callback("b", True)
+    assert ids(tree, "b") == ["b1", "b0"]
+    check(tree, w)
+    tree.sort_by(None)
+    tree.insert({"id": "z", "label": "z"})
+    assert ids(tree)[-1] == "z"
+
+
+def test_sync(tree):
+    w = bt.TreeWidget(tree)
+    w._open_callback("a", True)
+    target = bt.Tree()
+    target.insert_nested_dicts(
+        [
+            {"id": "b", "label": "b", "children": [{"id": "b1", "label": "b1"}]},
+            {
+                "id": "a",
+                "label": "A",
+                "children": [{"id": "a2", "label": "a2"}, {"id": "a0", "label": "a0"}],
+            },
+            {"id": "d", "label": "d", "children": [{"id": "c", "label": "c"}]},
+        ]
+    )
+    summary = tree.sync(target.to_list())
+    assert tree.to_list() == target.to_list()
+    assert summary["added"] == {"d"}
+    assert summary["removed"] == {"a1", "a2x", "b0"}
+    assert summary["updated"] == {"a"}
+    assert summary["moved"] == {"a", "a0", "c"}  # a longest run stays put
+    assert "a" in w.opened
+    check(tree, w)
+    tree.undo()
+    assert ids(tree) == ["a", "b", "c"] and ids(tree, "a2") == ["a2x"]
+    check(tree, w)
+
+
+def test_rescan(tmp_path):
+    make_files(tmp_path, ["a/one.txt", "a/two.txt", "b/three.txt"])
+    tree = bt.Tree()
+    tree.rglob(tmp_path, "*.txt")
+    w = bt.TreeWidget(tree)
+    w._open_callback(str(tmp_path / "a"), True)
+    os.remove(tmp_path / "a" / "two.txt")
+    make_files(tmp_path, ["a/four.txt", "c/five.txt"])
+    summary = tree.rescan()
+    assert str(tmp_path / "a" / "two.txt") in summary["removed"]
+    assert {str(tmp_path / "a" / "four.txt"), str(tmp_path / "c" / "five.txt")} <= summary["added"]
+    assert files(tree) == {str(p) for p in tmp_path.rglob("*.txt")}
+    assert str(tmp_path / "a") in w.opened
+    check(tree, w)
+    assert tree.rescan()["added"] == set()
+    with pytest.raises(ValueError):
+        bt.Tree().rescan()
+
+
+def test_save_load(tree, tmp_path):
+    path = tmp_path / "tree.bt"
+    tree.update("a1", size=3, tags=["x", "y"])
+    tree.save(path)
+    assert bt.Tree.load(path).to_list() == tree.to_list()
+
+    lazy = bt.Tree.load(path, lazy=True)
+    assert ids(lazy) == ["a", "b", "c"] and not isinstance(lazy.registry["c"], bt.LazyNode)
+    w = bt.TreeWidget(lazy)
+    w._open_callback("a", True)
+    lazy.save(path)  # over the file it is loading from
+    w._open_callback("b", True)
+    w._open_callback("a2", True)
+    assert lazy.to_list() == tree.to_list()
+    assert bt.Tree.load(path).to_list() == tree.to_list()
+    assert os.listdir(tmp_path) == ["tree.bt"]
+
+
+def test_save_after_editing_unopened_nodes(tree, tmp_path):
+    path, other = tmp_path / "tree.bt", tmp_path / "other.bt"
+    tree.save(path)
+    lazy = bt.Tree.load(path, lazy=True)
+    lazy.move("b", "a")  # into nodes whose children are still in the file
+    lazy.insert({"id": "new", "label": "new"}, "b")
+    lazy.save(other)
+    lazy.save(path)
+    tree.move("b", "a", 0)  # loaded children come after those given since
+    tree.insert({"id": "new", "label": "new"}, "b")
+    tree.move("new", "b", 0)
+    for saved in (other, path):
+        assert bt.Tree.load(saved).to_list() == tree.to_list()
+    w = bt.TreeWidget(lazy)
+    for id in ("a", "b", "a2"):
+        w._open_callback(id, True)
+    assert lazy.to_list() == tree.to_list()
+    check(lazy, w)
+
+
+def test_load_refuses_damaged_files(tree, tmp_path):
+    path = tmp_path / "tree.bt"
+    tree.save(path)
+    data = path.read_bytes()
+    for cut in (len(bt._SAVE_MAGIC) + 5, len(data) // 2, len(data) - 1):
+        path.write_bytes(data[:cut])
+        for lazy in (False, True):
+            with pytest.raises(ValueError):
+                tree = bt.Tree.load(path, lazy=lazy)
+                bt.TreeWidget(tree).expand_subtree("root")
+                for node in list(tree.registry.values()):
+                    tree.load_children(node)
+
+
+def test_save_refuses_unsupported_data(tree, tmp_path):
+    path = tmp_path / "tree.bt"
+    path.write_bytes(b"kept")
+    tree.update("b1", value=object())
+    with pytest.raises(ValueError, match="b1"):
+        tree.save(path)
+    assert path.read_bytes() == b"kept"
+    assert os.listdir(tmp_path) == ["tree.bt"]
+
+
+def test_load_refuses_other_files(tmp_path):
+    path = tmp_path / "tree.bt"
+    path.write_bytes(b"something else")
+    with pytest.raises(ValueError):
+        bt.Tree.load(path)
+    bt.Tree().save(path)
+    data = bytearray(path.read_bytes())
+    data[len(bt._SAVE_MAGIC) - 1] += 1  # another marshal version
+    path.write_bytes(data)
+    with pytest.raises(ValueError, match="marshal"):
+        bt.Tree.load(path)
+
+
+def test_select_ranges_and_toggles(tree):
+    w = bt.TreeWidget(tree)
+    w._open_callback("a", True)  # root a a0 a1 a2 b c
+    w._select_callback("a0")
+    w._select_callback("a2", extend=True)
+    assert w.selected_ids() == ["a0", "a1", "a2"]
+    w._select_callback("c", toggle=True)
+    w._select_callback("a1", toggle=True)
+    assert set(w.selected_ids()) == {"a0", "a2", "c"}
+    w._select_callback("b", extend=True, toggle=True)  # from a1, keeping the rest
+    assert set(w.selected_ids()) == {"a0", "a1", "a2", "b", "c"}
+    w._open_callback("a", False)  # hidden rows stay selected
+    assert set(w.selected_ids()) == {"a0", "a1", "a2", "b", "c"}
+    w._select_callback("b")
+    assert w.selected_ids() == ["b"] and w.selected_id == "b"
+
+
+def test_move_selected(tree):
+    w = bt.TreeWidget(tree)
+    w._open_callback("a", True)
+    w._select_callback("c")
+    w._select_callback("a0", toggle=True)
+    w.move_selected("b", 0)
+    assert ids(tree, "b") == ["a0", "c", "b0", "b1"]  # in tree order
+    check(tree, w)
+    tree.undo()
+    assert ids(tree) == ["a", "b", "c"] and ids(tree, "a") == ["a0", "a1", "a2"]
+    w._select_callback("a")
+    with pytest.raises(ValueError):
+        w.move_selected("a2")
+    w._select_callback("root")
+    w._select_callback("a", extend=True)  # the root cannot be moved
+    w.move_selected("b")
+    assert ids(tree, "b") == ["b0", "b1", "a"]
+    check(tree, w)
+
+
+def test_remove_selected(tree):
+    w = bt.TreeWidget(tree)
+    w._open_callback("a", True)
+    w._select_callback("a1")
+    w._select_callback("a2", extend=True)
+    w.remove_selected()
+    assert ids(tree, "a") == ["a0"] and "a2x" not in tree.registry
+    assert w.selected_ids() == []
+    check(tree, w)
+    w._select_callback("root")
+    w._select_callback("b", extend=True)
+    w.remove_selected()
+    assert ids(tree) == ["c"]
+    check(tree, w)
+    w.refresh()
+    tree.undo()
+    assert ids(tree) == ["a", "b", "c"]
+    check(tree, w)
+
+
+def test_open_selected(tree):
+    tree.add_node(bt.LazyNode({"id": "lazy", "label": "lazy"}, lambda node: [{"label": "x"}]))
+    w = bt.TreeWidget(tree)
+    w._select_callback("root")
+    w._select_callback("lazy", extend=True)
+    w.open_selected()
+    assert {"a", "b", "lazy"} <= w.opened and "c" not in w.opened
+    assert len(ids(tree, "lazy")) == 1
+    check(tree, w)
+    w.open_selected(False)
+    assert w.opened == {"root"}
+    check(tree, w)
+
+
+def test_batch_defers_housekeeping(tree):
+    calls = []
+    tree.onchange(lambda: calls.append(len(tree.registry)))
+    with tree.batch():
+        tree.insert({"id": "d", "label": "d"})
+        tree.move("a1", "d")
+        tree.update("c", label="see")
+        tree.remove("b0")
+        assert calls == []
+    assert calls == [10]
+    assert tree.last_change == {
+        "added": {"d"},
+        "moved": {"a1"},
+        "removed": {"b0"},
+        "updated": {"c"},
+    }
+    assert tree.registry["a1"].level == 2
+    check(tree)
+    tree.undo()  # one step
+    assert ids(tree) == ["a", "b", "c"] and "d" not in tree.registry
+
+
+def test_batch_after_an_error(tree):
+    with pytest.raises(RuntimeError):
+        with tree.batch():
+            tree.insert({"id": "d", "label": "d"}, "a")
+            raise RuntimeError
+    assert tree.last_change["added"] == {"d"}
+    assert tree.registry["d"].level == 2
+    tree.insert({"id": "e", "label": "e"})  # housekeeping is no longer deferred
+    assert tree.last_change["added"] == {"e"}
+
+
+def test_batch_changes_that_cancel_out(tree):
+    assert tree.search("apple") == set()
+    with tree.batch():
+        tree.insert({"id": "d", "label": "d"})
+        tree.move("d", "a")
+        tree.remove("d")
+    assert tree.last_change == {"added": set(), "moved": set(), "removed": set(), "updated": set()}
+    tree.update("a", label="apple")
+    assert tree.search("apple") == {"a"}
+    with tree.batch():
+        tree.remove("a")
+        tree.insert({"id": "a", "label": "banana"})
+    assert tree.last_change["updated"] == {"a"}
+    assert tree.last_change["removed"] == {"a0", "a1", "a2", "a2x"}
+    assert tree.search("apple") == set() and tree.search("banana") == {"a"}
+    with tree.batch():
+        tree.remove("a")
+        tree.insert({"id": "a", "label": "cherry"})
+        tree.remove("a")
+    assert tree.last_change["removed"] == {"a"} and tree.last_change["updated"] == set()
+    assert tree.search("banana") == tree.search("cherry") == set()
+    check(tree)
+
+
+class Mirror:
+    """Follows a tree's parents through its events alone"""
+
+    def __init__(self, tree):
+        self.parents = {id: node.parent for id, node in tree.registry.items() if id != "root"}
+        tree.subscribe(self.apply, bt.NodeAdded, bt.NodeRemoved, bt.NodeMoved)
+
+    def apply(self, events):
+        for event in events:
+            if isinstance(event, bt.NodeAdded):
+                assert event.id not in self.parents
+                assert event.parent == "root" or event.parent in self.parents
+                self.parents[event.id] = event.parent
+            elif isinstance(event, bt.NodeRemoved):
+                assert self.parents[event.id] == event.parent
+                for id in event.subtree:
+                    del self.parents[id]
+            else:
+                assert self.parents[event.id] == event.old_parent
+                self.parents[event.id] = event.parent
+
+
+def test_subscribe(tree):
+    events, updates = [], []
+    tree.subscribe(events.extend)
+    tree.subscribe(updates.extend, bt.NodeUpdated)
+    tree.insert({"id": "d", "label": "d"}, "b")
+    tree.move("d", "a", 0)
+    tree.update("d", label="dee")
+    tree.remove("a2")
+    assert events == [
+        bt.NodeAdded("d", "b", 2),
+        bt.NodeMoved("d", "b", "a", 0),
+        bt.NodeUpdated("d", ("label",)),
+        bt.NodeRemoved("a2", "a", ("a2", "a2x")),
+    ]
+    assert updates == [bt.NodeUpdated("d", ("label",))]
+    tree.unsubscribe(events.extend)
+    tree.update("d", label="d")
+    assert len(events) == 4 and len(updates) == 2
+    opened = []
+    tree.subscribe(opened.extend, bt.OpenChanged)
+    w = bt.TreeWidget(tree)
+    w._open_callback("a", True)
+    assert opened == [bt.OpenChanged("a", True, 1, w)] and len(updates) == 2
+
+
+def test_batch_events_are_coalesced(tree):
+    events = []
+    tree.subscribe(events.extend)
+    with tree.batch():
+        tree.move("c", "a")
+        tree.move("c", "b", 0)
+        tree.update("b0", label="x")
+        tree.update("b0", size=1)
+        tree.insert({"id": "x", "label": "x"}, "a")
+        tree.insert({"id": "y", "label": "y"}, "x")
+        tree.remove("x")  # never seen
+        tree.insert({"id": "d", "label": "d"})
+        tree.insert({"id": "e", "label": "e"}, "d")
+        tree.move("a1", "d")
+        tree.remove("d")  # only a1 was seen, under a
+    assert events == [
+        bt.NodeMoved("c", "root", "b", 0),
+        bt.NodeUpdated("b0", ("label", "size")),
+        bt.NodeRemoved("a1", "a", ("a1",)),
+    ]
+
+
+def test_events_mirror_the_tree(small_blocks):
+    rng = random.Random(2)
+    tree = bt.Tree()
+    tree.insert_nested_dicts(
+        [{"label": str(i), "children": [{"label": f"{i}.{j}"} for j in range(3)]} for i in range(5)]
+    )
+    mirror = Mirror(tree)
+    for _ in range(150):
+        with tree.batch():
+            for _ in range(rng.randrange(1, 10)):
+                nodes = [id for id in tree.registry if id != "root"]
+                op = rng.choice(["move", "move", "insert", "remove", "flat", "children"])
+                if op == "insert" or len(nodes) < 3:
+                    data = [{"label": "x", "children": [{"label": "y"}]}]
+                    tree.insert_nested_dicts(data, rng.choice(list(tree.registry)))
+                elif op == "move":
+                    node = rng.choice(nodes)
+                    subtree = {n.id for n in tree.dfs(node)}
+                    tree.move(node, rng.choice([id for id in tree.registry if id not in subtree]))
+                elif op == "remove":
+                    tree.remove(rng.choice(nodes))
+                elif op == "flat":
+                    tree.remove(rng.choice(nodes), recursive=False)
+                else:
+                    tree.remove_children(rng.choice(nodes))
+        assert mirror.parents == {id: n.parent for id, n in tree.registry.items() if id != "root"}
+
+
+def test_traverse(tree):
+    assert [(n.id, depth) for n, depth in tree.traverse()] == [
+        ("root", 0),
+        ("a", 1),
+        ("a0", 2),
+        ("a1", 2),
+        ("a2", 2),
+        ("a2x", 3),
+        ("b", 1),
+        ("b0", 2),
+        ("b1", 2),
+        ("c", 1),
+    ]
+    post = [n.id for n, _ in tree.traverse(order="post")]
+    assert post == ["a0", "a1", "a2x", "a2", "a", "b0", "b1", "b", "c", "root"]
+    level = [n.id for n, _ in tree.traverse(order="level")]
+    assert level == ["root", "a", "b", "c", "a0", "a1", "a2", "b0", "b1", "a2x"]
+    assert [n.id for n in tree.bfs()] == level
+    assert [n.id for n in tree.dfs("a")] == ["a", "a0", "a1", "a2", "a2x"]
+    assert [n.id for n, _ in tree.traverse("a", max_depth=1)] == ["a", "a0", "a1", "a2"]
+    pruned = [n.id for n, _ in tree.traverse(prune=lambda n: n.id == "a")]
+    assert pruned == ["root", "a", "b", "b0", "b1", "c"]
+    assert repr(tree).splitlines()[:3] == [repr(tree.root), " " + repr(tree.registry["a"]), "  a0"]
+
+
+def test_deep_chains():
+    depth = 3 * sys.getrecursionlimit()
+    chain = [{"id": str(i), "label": str(i), "children": [str(i + 1)]} for i in range(depth)]
+    chain[-1]["children"] = []
+    tree = bt.Tree(nodes=chain)
+    assert tree.registry[str(depth - 1)].level == depth
+    assert len(list(tree.dfs())) == depth + 1
+    assert len(repr(tree).splitlines()) == depth + 1
+    assert [n.id for n, _ in tree.traverse(order="post")][0] == str(depth - 1)
+    w = bt.TreeWidget(tree)
+    w.expand_subtree("root")
+    assert len(w.viewable_nodes) == depth + 1
+    w.goto_node(str(depth - 1))
+    tree.move(str(depth - 1), "root")
+    tree._validate()
+    rows = w.viewable_nodes  # `check` would be quadratic here
+    assert rows[depth].id == str(depth - 1)
+    assert rows.index(tree.registry[str(depth - 2)]) == depth - 1
+    tree.remove("0")
+    assert list(tree.registry) == ["root", str(depth - 1)]
+
+
+@pytest.mark.parametrize("renderer", ["widgets", "html"])
+def test_refresh_only_sends_what_changed(tree, renderer):
+    w = bt.TreeWidget(tree, height=6, renderer=renderer)
+    w.refresh()
+    assert w.refresh_messages == 0
+    tree.update("b", label="bee")
+    assert w.refresh_messages == 1  # the button of that row, or the HTML
+    w._select_callback("c")
+    assert w.refresh_messages == 1
+    # root a b c -> root a a0 a1 a2 b. Per row model: a's toggle, b -> a0
+    # (button, indent, toggle), c -> a1 (button, indent), two rows shown for
+    # the first time (3 models each) and the row list
+    w._open_callback("a", True)
+    assert w.refresh_messages == (1 + 3 + 2 + 3 + 3 + 1 if renderer == "widgets" else 1)
+    sent = w.messages_sent
+    w._open_callback("a", False)
+    w._open_callback("a", True)  # the last two rows still show a2 and b
+    assert w.refresh_messages == (1 + 3 + 2 + 1 if renderer == "widgets" else 1)
+    assert w.messages_sent > sent
+
+
+def test_html_rows(tree):
+    opened, selected = [], []
+    rows = bt.HTMLRows(lambda *args: opened.append(args), lambda *a, **k: selected.append((a, k)))
+    tree.update("c", label="<c & d>")
+    nodes = [tree.registry[id] for id in ("a", "a0", "c")]
+    assert rows.load(nodes, [False, True, False], [True, False, False]) == 1
+    assert rows.load(nodes, [False, True, False], [True, False, False]) == 0
+    assert rows.value.count("better-tree-html-row") == 3
+    assert rows.value.count("better-tree-selected") == 1
+    assert "fa-chevron-down" in rows.value and "fa-chevron-right" not in rows.value
+    assert "&lt;c &amp; d&gt;" in rows.value
+
+    def click(row, x, **keys):
+        rows._click({"relativeY": (row + 0.5) * bt.ROW_HEIGHT, "relativeX": x, **keys})
+
+    level = tree.registry["a"].level
+    click(0, level * bt.INDENT + 1)  # a's toggle
+    assert opened == [("a", False)]
+    click(1, tree.registry["a0"].level * bt.INDENT + 1)  # a0 has no toggle
+    click(2, 200, shiftKey=True)
+    click(2, 200, metaKey=True)
+    click(3, 200)  # below the rows
+    assert selected == [
+        (("a0",), {"extend": False, "toggle": False}),
+        (("c",), {"extend": True, "toggle": False}),
+        (("c",), {"extend": False, "toggle": True}),
+    ]
+
+
+def test_html_renderer(tree):
+    w = bt.TreeWidget(tree, renderer="html")
+    assert w.node_window.children == (w.html_rows,)
+    assert [n.id for n in w.html_rows.nodes] == ["root", "a", "b", "c"]
+    w.html_rows._click({"relativeY": 1.5 * bt.ROW_HEIGHT, "relativeX": bt.INDENT + 1})
+    assert "a" in w.opened
+    assert [n.id for n in w.html_rows.nodes] == ["root", "a", "a0", "a1", "a2", "b", "c"]
+    w.html_rows._click({"relativeY": 2.5 * bt.ROW_HEIGHT, "relativeX": 100})
+    assert w.selected_ids() == ["a0"]
+    with pytest.raises(ValueError):
+        bt.TreeWidget(tree, renderer="canvas")
+
+
+def wheel_widget(n=100, **options):
+    tree = bt.Tree()
+    tree.bulk_insert([{"label": str(i)} for i in range(n)])
+    w = bt.TreeWidget(tree, height=10, **options)
+    w.momentum = 0  # rows are then exactly the wheel deltas
+    renders = []
+    refresh = w.refresh
+    w.refresh = lambda: renders.append(w.cursor) or refresh()
+    return w, renders
+
+
+def test_wheel_units():
+    w, renders = wheel_widget()
+    w.event_handler({"deltaY": 3 * bt.ROW_HEIGHT, "deltaMode": 0})  # pixels
+    w.event_handler({"deltaY": 2, "deltaMode": 1})  # lines
+    w.event_handler({"deltaY": 1, "deltaMode": 2})  # pages
+    assert renders == [3, 5, 15]  # no event loop: rendered at once
+    w.event_handler({"deltaY": -1000, "deltaMode": 1})
+    assert w.cursor == 0 and w._compute_inview()[0].id == "root"
+    w.event_handler({"deltaY": bt.ROW_HEIGHT / 2})  # the fraction is kept
+    w.event_handler({"deltaY": bt.ROW_HEIGHT / 2})
+    assert w.cursor == 1
+
+
+def test_wheel_events_are_coalesced_into_frames():
+    async def scroll():
+        w, renders = wheel_widget(frame_interval=0.05)
+        for _ in range(10):
+            w.event_handler({"deltaY": 1, "deltaMode": 1})
+        assert renders == [1]  # the first at once, the rest wait for the next frame
+        await asyncio.sleep(0.1)
+        assert renders == [1, 10]
+        await asyncio.sleep(0.1)
+        assert renders == [1, 10]
+
+    asyncio.run(scroll())
+
+
+def test_expand_and_collapse(tree):
+    tree.insert({"id": "a2y", "label": "a2y"}, "a2x")
+    tree.add_node(bt.LazyNode({"id": "lazy", "label": "lazy"}, lambda node: [{"label": "x"}]))
+    w = bt.TreeWidget(tree)
+    events, renders = [], []
+    tree.subscribe(events.extend, bt.OpenChanged)
+    refresh = w.refresh
+    w.refresh = lambda: renders.append(1) or refresh()
+
+    w.expand_subtree("a", 2)
+    assert w.opened == {"root", "a", "a2"}
+    assert events == [bt.OpenChanged("a", True, 2, w)] and len(renders) == 1
+    check(tree, w)
+    w.expand_subtree("root")
+    assert w.opened == {"root", "a", "a2", "a2x", "b"}  # not the lazy node
+    assert ids(tree, "lazy") == []
+    check(tree, w)
+    w.collapse_subtree("a")
+    assert w.opened == {"root", "b"}
+    check(tree, w)
+    w.expand_to_level(2)
+    rows = [n.id for n in w.viewable_nodes]
+    assert rows == ["root", "a", "a0", "a1", "a2", "b", "b0", "b1", "c", "lazy"]
+    w.expand_to_level(1)
+    assert w.opened == {"root"}
+    assert len(renders) == 5
+    check(tree, w)
+
+
+def test_ainsert_nested_dicts(tree):
+    def data():
+        return [
+            {"label": str(i), "children": [{"label": f"{i}.{j}"} for j in range(4)]}
+            for i in range(30)
+        ]
+
+    w = bt.TreeWidget(tree)
+    shown = []
+    tree.onchange(lambda: shown.append(len(w.viewable_nodes)))
+
+    async def load():
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(1)
+                await asyncio.sleep(0)
+
+        ticker = asyncio.ensure_future(tick())
+        await tree.ainsert_nested_dicts(data(), "b", chunk_size=20)
+        ticker.cancel()
+        return len(ticks)
+
+    assert asyncio.run(load()) >= 150 // 20  # the loop ran between chunks
+    assert len(shown) > 1 and shown == sorted(shown)  # shown as they came in
+    expected = bt.Tree()
+    expected.insert_nested_dicts(data())
+    labels = lambda tree, id: [tree.registry[c].data["label"] for c in ids(tree, id)]
+    assert labels(tree, "b")[2:] == labels(expected, "root")
+    assert len(tree.registry) == 10 + 150
+    check(tree, w)
+    tree.undo()  # one step
+    assert len(tree.registry) == 10 and ids(tree, "b") == ["b0", "b1"]
+    check(tree, w)
+
+
+def test_instrument(tree):
+    calls = []
+    tree.instrument()
+    tree.instrument(hook=lambda *call: calls.append(call))  # replaces, no double wrapping
+    tree.insert({"id": "d", "label": "apple"})
+    tree.search("apple")
+    stats = tree.stats()
+    assert stats["_housekeeping"]["calls"] == 1
+    assert stats["search"] == {
+        "calls": 1,
+        "total": stats["search"]["total"],
+        "p50": stats["search"]["p50"],
+        "p99": stats["search"]["p99"],
+        "nodes": 1,
+    }
+    assert stats["_compute_depth"]["nodes"] == 1
+    assert ("search", stats["search"]["total"], 1) in calls
+    assert "undo" not in stats  # not called yet
+    tree.instrument(False)
+    assert not set(bt.Tree.PHASES) & vars(tree).keys()  # the methods are uncovered
+    assert tree.stats() == {}
+
+    w = bt.TreeWidget(tree)
+    w.instrument()
+    w._open_callback("a", True)
+    stats = w.stats()
+    assert stats["refresh"]["calls"] == 1 and stats["refresh"]["messages"] == w.refresh_messages
+    assert stats["_set_opened"]["calls"] == 1
+    w.instrument(False)
+    assert not set(bt.TreeWidget.PHASES) & vars(w).keys()
+    assert w.stats() == {}